@@ -1,13 +1,8 @@
-# Colorado River
-bash bash/stereo_rectify.sh \
-2022-05-15_ColoradoRiver \
-_boson_thermal_image_raw \
-_eo_color_image_color_compressed \
-_eo_mono_image_mono_compressed
-
-# Castaic
-bash bash/stereo_rectify.sh \
-2022-12-20_Castaic_Lake \
-_boson_thermal_image_raw \
-_eo_color_image_color_compressed \
-_eo_mono_image_mono_compressed
+# Colorado River and Castaic, in one run so the cores stay busy across trajectories and places
+python batch_stereo_rectify.py \
+--data_path onr-thermal \
+--places 2022-05-15_ColoradoRiver 2022-12-20_Castaic_Lake \
+--thermal_csv _boson_thermal_image_raw.csv \
+--color_csv _eo_color_image_color_compressed.csv \
+--mono_csv _eo_mono_image_mono_compressed.csv \
+--output_path onr-thermal-paired
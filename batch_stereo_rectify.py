@@ -0,0 +1,83 @@
+import argparse
+import glob
+import os
+
+from utils.rectifier import calibration_file_hash
+from stereo_rectify import (TrajectoryOutput, trajectory_tasks, run_rectify_pipeline, load_sync_df,
+                            add_rectify_args, parse_products)
+
+
+def find_trajectories(data_path, places):
+    # Every <data_path>/<place>/<trajectory>/csv, places may be glob patterns
+    trajectories = []
+    for place in places:
+        for csv_dir in sorted(glob.glob(os.path.join(data_path, place, '*', 'csv'))):
+            trajectories.append(os.path.dirname(csv_dir))
+    return sorted(set(trajectories))
+
+
+def trajectory_output_dir(data_path, trajectory_dir, output_path):
+    # <output_path>/<place>/<trajectory>/stereo_rectified, as bash/stereo_rectify.sh used to lay it out
+    return os.path.join(output_path, os.path.relpath(trajectory_dir, data_path), 'stereo_rectified')
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Stereo rectify every trajectory of one or more places through a single shared work queue')
+    parser.add_argument('--data_path', type=str, default='onr-thermal')
+    parser.add_argument('--places', type=str, nargs='+', required=True,
+                        help='Place folders under data_path, glob patterns allowed (e.g. "2022-*")')
+    parser.add_argument('--output_path', type=str, default='onr-thermal-paired')
+    parser.add_argument('--thermal_csv', type=str, default='_boson_thermal_image_raw.csv')
+    parser.add_argument('--mono_csv', type=str, default='_eo_mono_image_mono_compressed.csv')
+    parser.add_argument('--color_csv', type=str, default='_eo_color_image_color_compressed.csv')
+    add_rectify_args(parser)
+    args = parser.parse_args()
+    print(args)
+
+    products = parse_products(parser, args)
+
+    trajectories = find_trajectories(args.data_path, args.places)
+    if not trajectories:
+        parser.error('No */csv trajectories found for {} under {}'.format(' '.join(args.places), args.data_path))
+
+    calib_yamls = {
+        'thermal_mono': args.thermal_mono_calib_yaml,
+        'thermal_color': args.color_thermal_calib_yaml,
+    }
+    calib_hashes = {pair_type: calibration_file_hash(calib_yaml) for pair_type, calib_yaml in calib_yamls.items()}
+
+    outputs = {}
+    queued = []
+    for trajectory_dir in trajectories:
+        output_dir = trajectory_output_dir(args.data_path, trajectory_dir, args.output_path)
+        try:
+            sync_df = load_sync_df(trajectory_dir, args.thermal_csv, args.mono_csv, args.color_csv, output_dir,
+                                   args.sync_tolerance, args.thermal_smoothing)
+        except (OSError, ValueError) as e:
+            print('Skipping {}: {!r}'.format(trajectory_dir, e))
+            continue
+
+        output = TrajectoryOutput(output_dir, products, args.sink, args.shard_size_mb << 20)
+        outputs[output_dir] = output
+        tasks, n_pairs, n_todo = trajectory_tasks(trajectory_dir, sync_df, output, calib_hashes, args.rotate180,
+                                                  args.clahe_backend, args.force)
+        queued.append((trajectory_dir, tasks, n_pairs, n_todo))
+
+    # Largest trajectories first, so the long ones are not left running alone at the end
+    queued.sort(key=lambda entry: len(entry[1]), reverse=True)
+
+    print('{:<60} {:>8} {:>10}'.format('trajectory', 'pairs', 'to process'))
+    for trajectory_dir, tasks, n_pairs, n_todo in queued:
+        print('{:<60} {:>8d} {:>10d}'.format(os.path.relpath(trajectory_dir, args.data_path), n_pairs, n_todo))
+    print('{:<60} {:>8d} {:>10d}'.format('total', sum(entry[2] for entry in queued), sum(entry[3] for entry in queued)))
+
+    tasks = [task for entry in queued for task in entry[1]]
+    stats = run_rectify_pipeline(tasks, outputs, calib_yamls, args.rotate180, args.clahe_backend, args.n_workers,
+                                 products, desc='Rectifying {} trajectories'.format(len(queued)))
+    for output in outputs.values():
+        output.close()
+
+    if stats['failures'] > 0:
+        raise SystemExit(1)
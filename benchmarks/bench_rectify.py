@@ -0,0 +1,263 @@
+import argparse
+import csv
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(REPO_ROOT)
+
+from utils.rectifier import StereoRectifier
+from stereo_rectify import (PAIR_TYPES, PRODUCTS, normalize_thermal_img, thermal_eo_offset, read_image,
+                            stereo_rectify_helper, load_sync_df, stereo_rectify_pipeline, shard_members)
+from utils.autoscale import DEFAULT_CLAHE_BACKEND
+
+CALIB_YAMLS = {
+    'thermal_mono': os.path.join(REPO_ROOT, 'calibrations', 'thermal_mono_10x10_calib.yaml'),
+    'thermal_color': os.path.join(REPO_ROOT, 'calibrations', 'color_thermal_10x10_calib.yaml'),
+}
+STREAMS = {
+    'thermal': ('_boson_thermal_image_raw.csv', 'images/boson/thermal/image_raw', '.tiff'),
+    'mono': ('_eo_mono_image_mono_compressed.csv', 'images/eo/mono/image_mono/compressed', '.jpg'),
+    'color': ('_eo_color_image_color_compressed.csv', 'images/eo/color/image_color/compressed', '.jpg'),
+}
+
+
+def make_trajectory(root, n_frames, thermal_size, eo_size, seed=0):
+    # Smooth synthetic scenes in the extracted trajectory layout (csv/ + images/), thermal frames are centred
+    # in the EO frame as on the real payload
+    rng = np.random.default_rng(seed)
+    tW, tH = thermal_size
+    W, H = eo_size
+
+    for name, (csv_name, folder, ext) in STREAMS.items():
+        os.makedirs(os.path.join(root, folder), exist_ok=True)
+        os.makedirs(os.path.join(root, 'csv'), exist_ok=True)
+        with open(os.path.join(root, 'csv', csv_name), 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['Time', 'header.seq', 'header.stamp.secs', 'header.stamp.nsecs', 'header.frame_id',
+                             'filename'])
+            for i in range(n_frames):
+                t = 1.6e9 + i / 30
+                filename = os.path.join(folder, 'image-{:05d}{}'.format(i, ext))
+                if name == 'thermal':
+                    noise = rng.normal(0, 2500, (tH, tW)).astype(np.float32)
+                    img = (cv2.GaussianBlur(noise, (0, 0), 6) + 22000 + 30 * i).clip(0, 65535).astype(np.uint16)
+                else:
+                    noise = rng.random((H // 8, W // 8, 3)).astype(np.float32) * 255
+                    img = cv2.resize(noise, (W, H), interpolation=cv2.INTER_CUBIC).clip(0, 255).astype(np.uint8)
+                    if name == 'mono':
+                        img = img[:, :, 0]
+                cv2.imwrite(os.path.join(root, filename), img)
+                writer.writerow(['{:.7f}'.format(t), i, int(t), int(round(t % 1 * 1e9)), 'cam', filename])
+
+
+def summarize(seconds):
+    ms = np.array(seconds) * 1e3
+    return {
+        'n': len(ms),
+        'mean_ms': float(ms.mean()),
+        'median_ms': float(np.median(ms)),
+        'p95_ms': float(np.percentile(ms, 95)),
+    }
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def bench_stages(data_dir, sync_df, out_dir, clahe_backend):
+    # Single process latency of each stage of one sync row, both pairings, all products
+    srs = {pair_type: StereoRectifier(calib_yaml) for pair_type, calib_yaml in CALIB_YAMLS.items()}
+    os.makedirs(out_dir, exist_ok=True)
+
+    times = {stage: [] for stage in ['read', 'autoscale', 'remap', 'encode', 'write']}
+    for _, row in sync_df.iterrows():
+        thermal_path = os.path.join(data_dir, row['thermal_filepath'])
+        eo_paths = [os.path.join(data_dir, row['mono_filepath']), os.path.join(data_dir, row['color_filepath'])]
+
+        start = time.perf_counter()
+        thermal_img, _ = read_image(thermal_path, -1)
+        eo_imgs = [read_image(path, 1)[0] for path in eo_paths]
+        times['read'].append(time.perf_counter() - start)
+
+        thermal8_img, seconds = timed(normalize_thermal_img, thermal_img, clahe_backend)
+        times['autoscale'].append(seconds)
+
+        start = time.perf_counter()
+        rectified = {}
+        for pair_type, eo_img in zip(PAIR_TYPES, eo_imgs):
+            thermal_cam, eo_cam = (0, 1) if pair_type == 'thermal_mono' else (1, 0)
+            offset = thermal_eo_offset(thermal_img, eo_img)
+            thermal_rect, thermal8_rect = srs[pair_type].rectify_imgs(thermal_cam, thermal_img, thermal8_img,
+                                                                      src_offset=offset)
+            eo_rect, = srs[pair_type].rectify_imgs(eo_cam, eo_img)
+            rectified[pair_type] = {'thermal': thermal_rect, 'thermal8': thermal8_rect, 'eo': eo_rect}
+        times['remap'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        encoded = {}
+        for pair_type, products in rectified.items():
+            members = shard_members(thermal_path, pair_type)
+            for product, img in products.items():
+                encoded[members[product]] = cv2.imencode(os.path.splitext(members[product])[1], img)[1]
+        times['encode'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for name, buf in encoded.items():
+            buf.tofile(os.path.join(out_dir, name.replace('/', '_')))
+        times['write'].append(time.perf_counter() - start)
+
+    return {stage: summarize(seconds) for stage, seconds in times.items()}
+
+
+def bench_helper(data_dir, sync_df, out_dir, clahe_backend):
+    # End to end stereo_rectify_helper, one call per pair as in the original serial loop
+    srs = {pair_type: StereoRectifier(calib_yaml) for pair_type, calib_yaml in CALIB_YAMLS.items()}
+    seconds = []
+    for _, row in sync_df.iterrows():
+        for pair_type, eo_column in zip(PAIR_TYPES, ['mono_filepath', 'color_filepath']):
+            _, s = timed(stereo_rectify_helper, srs[pair_type], os.path.join(data_dir, row['thermal_filepath']),
+                         os.path.join(data_dir, row[eo_column]), pair_type, out_dir, False, clahe_backend)
+            seconds.append(s)
+    return summarize(seconds)
+
+
+def bench_scaling(data_dir, sync_df, out_root, clahe_backend, worker_counts, sink):
+    n_pairs = int(sync_df['mono_filepath'].notna().sum() + sync_df['color_filepath'].notna().sum())
+    results = []
+    for n_workers in worker_counts:
+        out_dir = os.path.join(out_root, 'workers_{}'.format(n_workers))
+        report = stereo_rectify_pipeline(data_dir, sync_df, CALIB_YAMLS, out_dir, clahe_backend=clahe_backend,
+                                         n_workers=n_workers, force=True, sink=sink)
+        results.append({
+            'n_workers': n_workers,
+            'wall_s': report['wall_s'],
+            'pairs_per_s': n_pairs / report['wall_s'],
+            'stages': {stage: report[stage] for stage in ['read', 'compute', 'write']},
+        })
+        shutil.rmtree(out_dir, ignore_errors=True)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    # Ratio of this run's latency / throughput to a previous run's
+    print('\n{:<24} {:>10} {:>10} {:>8}'.format('vs ' + str(baseline.get('commit')), 'before', 'now', 'ratio'))
+    for stage, now in results['stages'].items():
+        before = baseline.get('stages', {}).get(stage)
+        if before:
+            print('{:<24} {:>8.2f}ms {:>8.2f}ms {:>7.2f}x'.format(
+                stage, before['median_ms'], now['median_ms'], now['median_ms'] / before['median_ms']))
+    before_scaling = {entry['n_workers']: entry for entry in baseline.get('scaling', [])}
+    for entry in results['scaling']:
+        before = before_scaling.get(entry['n_workers'])
+        if before:
+            print('{:<24} {:>8.1f}/s {:>8.1f}/s {:>7.2f}x'.format(
+                'pipeline {} workers'.format(entry['n_workers']), before['pairs_per_s'], entry['pairs_per_s'],
+                entry['pairs_per_s'] / before['pairs_per_s']))
+
+
+def parse_size(text):
+    w, h = text.lower().split('x')
+    return int(w), int(h)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark the stereo rectification hot path on synthetic frames')
+    parser.add_argument('--n_frames', type=int, default=50)
+    parser.add_argument('--thermal_size', type=parse_size, default=(640, 512),
+                        help='WxH of the synthetic 16-bit thermal frames (Boson: 640x512)')
+    parser.add_argument('--eo_size', type=parse_size, default=(960, 600),
+                        help='WxH of the synthetic EO frames, as in the calibrations')
+    parser.add_argument('--clahe_backend', type=str, default=DEFAULT_CLAHE_BACKEND)
+    parser.add_argument('--workers', type=str, default=None,
+                        help='Comma separated worker counts for the scaling run. Default: 1, 2, 4, ... up to the core count')
+    parser.add_argument('--sink', type=str, default='files', choices=['files', 'shards'])
+    parser.add_argument('--work_dir', type=str, default=None, help='Default: a temporary directory')
+    parser.add_argument('--output', type=str, default='benchmark_results.json')
+    parser.add_argument('--compare', type=str, default=None, help='Results JSON of an earlier run to compare against')
+    args = parser.parse_args()
+
+    if args.workers:
+        worker_counts = [int(n) for n in args.workers.split(',')]
+    else:
+        n_cpu = os.cpu_count() or 1
+        worker_counts = sorted({min(2 ** i, n_cpu) for i in range(n_cpu.bit_length() + 1)})
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='bench_rectify_')
+    data_dir = os.path.join(work_dir, 'trajectory')
+    try:
+        print('Generating {} synthetic frames in {}'.format(args.n_frames, data_dir))
+        make_trajectory(data_dir, args.n_frames, args.thermal_size, args.eo_size)
+        sync_df = load_sync_df(data_dir, STREAMS['thermal'][0], STREAMS['mono'][0], STREAMS['color'][0],
+                               os.path.join(work_dir, 'out'))
+
+        # Build (or load) the rectification maps before anything is timed
+        for calib_yaml in CALIB_YAMLS.values():
+            StereoRectifier(calib_yaml)
+
+        results = {
+            'commit': git_commit(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'machine': {
+                'platform': platform.platform(),
+                'processor': platform.processor(),
+                'cpu_count': os.cpu_count(),
+                'python': platform.python_version(),
+                'numpy': np.__version__,
+                'opencv': cv2.__version__,
+            },
+            'config': {
+                'n_frames': args.n_frames,
+                'thermal_size': list(args.thermal_size),
+                'eo_size': list(args.eo_size),
+                'clahe_backend': args.clahe_backend,
+                'products': PRODUCTS,
+                'sink': args.sink,
+            },
+        }
+        results['stages'] = bench_stages(data_dir, sync_df, os.path.join(work_dir, 'stages'), args.clahe_backend)
+        results['stages']['stereo_rectify_helper'] = bench_helper(
+            data_dir, sync_df, os.path.join(work_dir, 'helper'), args.clahe_backend)
+        results['scaling'] = bench_scaling(data_dir, sync_df, os.path.join(work_dir, 'scaling'), args.clahe_backend,
+                                           worker_counts, args.sink)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    # Stages are per sync row (both pairings), the helper per pair
+    print('\n{:<24} {:>10} {:>10} {:>10}'.format('stage', 'median', 'mean', 'p95'))
+    for stage, stats in results['stages'].items():
+        print('{:<24} {:>8.2f}ms {:>8.2f}ms {:>8.2f}ms'.format(stage, stats['median_ms'], stats['mean_ms'],
+                                                               stats['p95_ms']))
+    print('\n{:<24} {:>10} {:>10}'.format('workers', 'pairs/s', 'speedup'))
+    for entry in results['scaling']:
+        print('{:<24} {:>10.1f} {:>9.2f}x'.format(
+            entry['n_workers'], entry['pairs_per_s'], entry['pairs_per_s'] / results['scaling'][0]['pairs_per_s']))
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('\nSaved {}'.format(args.output))
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare(results, json.load(f))
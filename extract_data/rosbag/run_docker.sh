@@ -10,7 +10,8 @@ set -e
 
 echo "Building and starting bag processing docker image"
 
-docker build -t bag_processing -f Dockerfile .
+# Build from the repository root so the shared utils/ package is in the build context
+docker build -t bag_processing -f Dockerfile ../..
 
 FOLDER_TO_EXPORT=/home/user/bags/
 
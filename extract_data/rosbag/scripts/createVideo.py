@@ -3,8 +3,10 @@
 # General imports
 import os
 import re
+import sys
 import glob
 import shutil
+import subprocess
 import csv
 import math
 import numpy as np
@@ -13,12 +15,21 @@ from numpy.lib.function_base import percentile
 
 import argparse
 
+# Thermal scaling is shared with the stereo rectification code in the repo-level utils/ package.
+# Inside the docker image utils/ is copied next to this script instead
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..'))
+from utils.autoscale import StreamingAutoScaler, uint16_to_uint8
+from utils.shards import ShardWriter, ShardReader, is_shard_dir
+from utils.sync import synchronize
+
 # Inputs
 root_directory = os.path.join(os.getcwd(),'data')
 root_directory = '/data'
 
 percentile_lo = 10   # Depth lower cutoff [10]
 percentile_hi = 90  # Depth upper cutoff [90]
+valid_range = (11, 65499)  # Pixel values outside this are ignored when finding the cutoffs
+autoscale_alpha = 0.2  # Temporal smoothing of the cutoffs, 1 = independent per frame [0.2]
 
 payload_inverted = 1
 
@@ -38,18 +49,15 @@ img_array_ref = (0,1)  # Index of timing reference image
 # If we have an arg, override the root_directory variable
 parser = argparse.ArgumentParser()
 parser.add_argument('-p', '--path', type=str, default=root_directory, help='Path to rosbag files')
+parser.add_argument('--sink', type=str, default='files', choices=['files','shards'], help='Write video frames as separate .jpg files or packed into tar shards')
 args = parser.parse_args()
 root_directory = args.path
+frame_sink = args.sink
 
 # Find all the bag files in the directory
 bags = sorted(glob.glob(os.path.join(root_directory,"**/*.bag"), recursive=True))
 
-def imageData_from_csv(csv_file) :
-    counter = 0
-
-    idx = []
-    t = []
-    filenames = []
+def find_csv(csv_file) :
 
     if not os.path.exists(csv_file) and not os.path.isfile(csv_file) :
         # If we can't find the file first time around, 
@@ -57,30 +65,20 @@ def imageData_from_csv(csv_file) :
         csv_file = csv_file.replace('_compressedDepth','')
         csv_file = csv_file.replace('_compressed','')
 
-    # Import the file if it exists
+    # Return the file if it exists
     if os.path.exists(csv_file) and os.path.isfile(csv_file) :
-        with open(csv_file, newline='') as csvfile:
-            reader = csv.reader(csvfile, delimiter=',')
-            next(reader)
-
-            for row in reader:
-                idx.append(counter)
-                t.append(float(row[2]) + float(row[3])/1e9)
-                filenames.append(row[5])
-                counter += 1
+        return csv_file
 
-    return idx, t, filenames
+    return None
 
-def get_closest_image(bagRoot,t_array,idx_array,filename_array,t_frame) :
+def get_closest_image(bagRoot,filename_array,idx_closest) :
 
-    # Gets the image closest to the given time
+    # Opens the image matched to the frame time
     img = None
 
-    if len(t_array) > 3 : 
-        # idx_closest  = int(math.floor(np.interp(t_frame,t_array,idx_array)))
-        idx_closest  = int((np.interp(t_frame,t_array,idx_array)))
-        if idx_closest >= len(filename_array) :
-            idx_closest = len(filename_array) - 1
+    if len(filename_array) > 3 : 
+        # Frames before the first image show the first one
+        idx_closest  = max(int(idx_closest), 0)
         filename     = os.path.join(bagRoot,filename_array[idx_closest])  
         img          = cv2.imread(filename, -1)   # For 16-bit (might also work for 8-bit)
         # img_cam2          = cv2.imread(filename_cam2, cv2.IMREAD_COLOR) # for 8-bit 
@@ -97,7 +95,12 @@ def get_closest_image(bagRoot,t_array,idx_array,filename_array,t_frame) :
 
     return idx_closest, img
 
-def uint16_2_uint8(img_dep) :
+def get_autoscaler(stats_file) :
+
+    # Streaming cutoffs for one 16-bit stream, reusing the statistics of an earlier run if there are any
+    return StreamingAutoScaler.load_or_create(stats_file, (percentile_lo, percentile_hi), autoscale_alpha, valid_range)
+
+def uint16_2_uint8(img_dep, scaler=None, key=None) :
 
     # Converts 16-bit depth image to an 8-bit image
 
@@ -105,22 +108,19 @@ def uint16_2_uint8(img_dep) :
         # Data already 8 bit
         return img_dep
 
-    # Clip out obvious endpoints
-    clipped_dep = img_dep[(10 < img_dep) & (img_dep < 65500)] 
-    if len(clipped_dep) == 0 :
+    if scaler is None :
+        scaler = StreamingAutoScaler((percentile_lo, percentile_hi), 1, valid_range)
+
+    # Cutoffs from the frame's histogram (obvious endpoints clipped out), smoothed over the stream
+    threshold_lo, threshold_hi = scaler.update(img_dep, key)
+    if threshold_lo is None :
         # Image is likely empty, just return what we have
         return img_dep
 
-    threshold_lo = np.percentile(clipped_dep,percentile_lo)  # 300
-    threshold_hi = np.percentile(clipped_dep,percentile_hi)  # 5000
-    img_dep[img_dep<threshold_lo] = threshold_lo
-    img_dep[img_dep>threshold_hi] = threshold_hi
-    cv2.normalize(img_dep, img_dep, 0, 65535, cv2.NORM_MINMAX)
-    np.right_shift(img_dep, 8, img_dep)
-    img_dep = np.uint8(img_dep)
-    img_dep = cv2.applyColorMap(img_dep, cv2.COLORMAP_MAGMA)
+    # Clip, stretch and colour map in a single lookup table gather (leaves the caller's image untouched)
+    _, img_color = uint16_to_uint8(img_dep, (threshold_lo, threshold_hi), colormap=cv2.COLORMAP_MAGMA)
 
-    return img_dep
+    return img_color
 
 def mono_2_rgb(img) :
     # We probably should add a check in here to make
@@ -173,11 +173,24 @@ def create_video(videoName,videoFrame_directory,framerate=30) :
         print(f"\t{output_name} already exists, skipping...")
         return
 
-    cmd = "ffmpeg -framerate " + str(round(framerate)) + " -start_number 0 -i " \
-        + os.path.join(videoFrame_directory,"%06d.jpg") + \
-        " -vf \"pad=ceil(iw/2)*2:ceil(ih/2)*2,format=yuv420p\"  -vcodec libx265 -crf 30 -y " \
-        + output_name
-    os.system(cmd)
+    if is_shard_dir(videoFrame_directory) :
+        # Stream the frames straight out of the shards, in order
+        cmd = ["ffmpeg", "-f", "image2pipe", "-framerate", str(round(framerate)), "-vcodec", "mjpeg", "-i", "-",
+               "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2,format=yuv420p", "-vcodec", "libx265", "-crf", "30", "-y",
+               output_name]
+        frames = ShardReader(videoFrame_directory)
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        for name in frames.names() :
+            proc.stdin.write(frames.read(name))
+        proc.stdin.close()
+        proc.wait()
+        frames.close()
+    else :
+        cmd = "ffmpeg -framerate " + str(round(framerate)) + " -start_number 0 -i " \
+            + os.path.join(videoFrame_directory,"%06d.jpg") + \
+            " -vf \"pad=ceil(iw/2)*2:ceil(ih/2)*2,format=yuv420p\"  -vcodec libx265 -crf 30 -y " \
+            + output_name
+        os.system(cmd)
 
     # Create a sped up version of the video (easier for checking for stuff)
     cmd = "ffmpeg -i " + output_name + " -filter:v setpts=PTS/10 -y " + output_name_fast
@@ -214,6 +227,14 @@ def combine_videos(root_directory, output_file) :
 
     return
 
+def count_video_frames(processedDir) :
+
+    # Number of frames already written, either as files or packed into shards
+    if is_shard_dir(processedDir) :
+        return len(ShardReader(processedDir))
+
+    return len([file for file in os.listdir(processedDir) if os.path.isfile(os.path.join(processedDir, file))])
+
 def create_video_frames(bagfile) :
 
     print("Processing "+bagfile)
@@ -224,46 +245,66 @@ def create_video_frames(bagfile) :
 
     processedDir = os.path.join(bagRoot,'processed')
 
-    ## Read csv files in by looping through array
-    idx_array = np.empty(img_array.shape, dtype=object)
-    t_array = np.empty(img_array.shape, dtype=object)
-    files_array = np.empty(img_array.shape, dtype=object)
+    ## Find the csv files by looping through array
+    csv_array = np.empty(img_array.shape, dtype=object)
+    cells = []  # Cells with a csv file, in the order given to the synchronizer
 
     for ii in range(img_array.shape[0]):
         for jj in range(img_array.shape[1]):
-            idx_array[ii,jj], t_array[ii,jj], files_array[ii,jj] = imageData_from_csv(os.path.join(bagRoot,'csv',img_array[ii,jj]))
+            csv_array[ii,jj] = find_csv(os.path.join(bagRoot,'csv',img_array[ii,jj]))
+            if csv_array[ii,jj] is not None :
+                cells.append((ii,jj))
 
-    # Check to make sure if we have timing data, if not, guess based on the highest number of frames
+    if len(cells) == 0 :
+        print("Not enough data, skipping this video")
+        return 0
+
+    # Per-stream thermal autoscale statistics, kept so re-runs skip recomputing them
+    stats_array = np.empty(img_array.shape, dtype=object)
+    scaler_array = np.empty(img_array.shape, dtype=object)
+    for ii in range(img_array.shape[0]):
+        for jj in range(img_array.shape[1]):
+            stats_array[ii,jj] = os.path.join(bagRoot,'autoscale',img_array[ii,jj].replace('.csv','.json'))
+            scaler_array[ii,jj] = get_autoscaler(stats_array[ii,jj])
+
+    # Match every stream to the frames of the timing reference in one go. Each frame shows the latest image
+    # at or before its time (header stamps), the index is cached next to csv/ for re-runs
+    csv_files = [csv_array[cell] for cell in cells]
+    syncDir = os.path.join(bagRoot,'sync')
     img_ref = img_array_ref
-    if len(t_array[img_ref]) == 0 :
-        print("\tNo timing data, trying other elements")
+    k_ref = cells.index(img_ref) if img_ref in cells else 0
+    sync = synchronize(csv_files, k_ref, direction='backward', time_source='header', sidecar_dir=syncDir)
 
-        max_frames = 0
+    # Check to make sure if we have timing data, if not, guess based on the highest number of frames
+    if img_ref not in cells or len(sync.times) == 0 :
+        print("\tNo timing data, trying other elements")
 
-        for ii in range(img_array.shape[0]):
-            for jj in range(img_array.shape[1]):
-                if len(t_array[ii,jj]) > max_frames :
-                    max_frames = len(t_array[ii,jj])
-                    img_ref = (ii,jj)
+        n_frames = [len(t) for t in sync.stream_times]
+        k_ref = int(np.argmax(n_frames))
+        img_ref = cells[k_ref]
+        max_frames = n_frames[k_ref]
         if max_frames > 10 :
             print(f"\t\tNow using {img_ref} for timing data ({max_frames} frames)")
+            sync = synchronize(csv_files, k_ref, direction='backward', time_source='header', sidecar_dir=syncDir)
         else :
             print("Not enough data, skipping this video")
             return 0
 
+    t_ref = sync.times
+
     # Calculate framerate
-    frame_rate = math.ceil(len(t_array[img_ref])/(t_array[img_ref][-1] - t_array[img_ref][0]))
+    frame_rate = math.ceil(len(t_ref)/(t_ref[-1] - t_ref[0]))
 
     # Skip if the timing frame data doesn't exist
-    if len(idx_array[img_ref]) < 5 :
+    if len(t_ref) < 5 :
         print("\tMissing reference camera information, skipping...")
         return None
 
     # Create output folder only if we haven't processed these files yet
     # matches the number of messages in the bag file
     if (os.path.exists(processedDir)) :
-        n_images_expected = len(idx_array[img_ref])
-        n_images_actual = len([file for file in os.listdir(processedDir) if os.path.isfile(os.path.join(processedDir, file))])
+        n_images_expected = len(t_ref)
+        n_images_actual = count_video_frames(processedDir)
         if (n_images_expected == n_images_actual) :
             print("\tVideo frames already created, skipping...")
             return frame_rate
@@ -275,11 +316,13 @@ def create_video_frames(bagfile) :
     if os.path.exists(processedDir) :
         shutil.rmtree(processedDir)
     os.makedirs(processedDir)
+    if frame_sink == 'shards' :
+        frame_shards = ShardWriter(processedDir, prefix='frames')
 
     # Loop through all the frames
     counter = 0
     subcounter = 0
-    for t in t_array[img_ref] :
+    for frame, t in enumerate(t_ref) :
 
         if (0) :
             if (subcounter % 10) :
@@ -303,10 +346,14 @@ def create_video_frames(bagfile) :
             for ii in range(img_array.shape[0]): # rows
 
                 # Import the images
-                frame_idx_array[ii,jj], frame_img_array[ii,jj] = get_closest_image(bagRoot,t_array[ii,jj],idx_array[ii,jj],files_array[ii,jj],t) 
+                if (ii,jj) in cells :
+                    k = cells.index((ii,jj))
+                    frame_idx_array[ii,jj], frame_img_array[ii,jj] = get_closest_image(bagRoot,sync.filenames[k],sync.index[frame,k])
+                else :
+                    frame_idx_array[ii,jj], frame_img_array[ii,jj] = get_closest_image(bagRoot,[],-1)
 
                 # Process any non-rbg8 images into something useful
-                frame_img_array[ii,jj] = uint16_2_uint8(frame_img_array[ii,jj])
+                frame_img_array[ii,jj] = uint16_2_uint8(frame_img_array[ii,jj],scaler_array[ii,jj],str(frame_idx_array[ii,jj]))
                 frame_img_array[ii,jj] = mono_2_rgb(frame_img_array[ii,jj])
 
                 # Rotate image if required
@@ -348,8 +395,11 @@ def create_video_frames(bagfile) :
             (10,15), cv2.FONT_HERSHEY_SIMPLEX, fontScale, color, fontThickness)
 
         imgName = ('%06d' % counter) + '.jpg'
-        filename_output = os.path.join(processedDir,imgName)
-        cv2.imwrite(filename_output,imgOut, [int(cv2.IMWRITE_JPEG_QUALITY), 70]) 
+        if frame_sink == 'shards' :
+            frame_shards.add_image(imgName, imgOut, [int(cv2.IMWRITE_JPEG_QUALITY), 70])
+        else :
+            filename_output = os.path.join(processedDir,imgName)
+            cv2.imwrite(filename_output,imgOut, [int(cv2.IMWRITE_JPEG_QUALITY), 70]) 
 
         # Debug image view
         # cv2.imshow('test',imgOut)
@@ -358,8 +408,17 @@ def create_video_frames(bagfile) :
         # Update the counter
         counter += 1
         if (counter % 100 == 0) :
-            t_offset = float(t)-float(t_array[img_ref][0])
-            print("\x1b[1K\r\t(" + ('%5d' % counter) + "/"+str(len(t_array[img_ref]))+") t: "+('%5.1f' % t_offset)+" ",end='')
+            t_offset = float(t)-float(t_ref[0])
+            print("\x1b[1K\r\t(" + ('%5d' % counter) + "/"+str(len(t_ref))+") t: "+('%5.1f' % t_offset)+" ",end='')
+
+    if frame_sink == 'shards' :
+        frame_shards.close()
+
+    # Save the thermal statistics of any 16-bit streams
+    for ii in range(img_array.shape[0]):
+        for jj in range(img_array.shape[1]):
+            if len(scaler_array[ii,jj].stats) > 0 :
+                scaler_array[ii,jj].save(stats_array[ii,jj])
 
     # Frames created for bagfile
     return frame_rate
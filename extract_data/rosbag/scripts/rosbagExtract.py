@@ -32,15 +32,25 @@ import os
 import re
 import shutil
 import csv
+import json
 import glob
+import bisect
+import heapq
 import subprocess
+import sys
+import time
+import traceback
 import argparse
+import operator
 import multiprocessing
+import multiprocessing.connection
 import pdb
+import queue
+import threading
 
 # ROS and image related imports
 import rosbag
-import bagpy
+import genpy
 import cv2
 import numpy as np  # Might be able to remove this once done
 from sensor_msgs.msg import Image
@@ -118,14 +128,85 @@ EMPTY = ''
 # count index formats
 COUNT = '{:3d}/{:3d} | {}'
 
-# Run in parallel?
-RUN_IN_PARALLEL = False
+# Bags extracted at once, each in its own process (1 extracts them one after another in this process)
+JOBS = 1
+
+# Time ranges one bag is split into, each extracted by its own process (1 reads the bag in one go)
+CHUNK_JOBS = 1
+
+# Part of each bag to extract: bag time window (seconds since the epoch, or from the bag's
+# start with a leading '+'), every nth message of each topic and at most max rate (Hz) per topic
+WINDOW_START = None
+WINDOW_END = None
+EVERY_NTH = 1
+MAX_RATE = None
+
+# Folder beside each bag for its csv/, images/ and logs/ (None puts them beside the bag).
+# A subset of each bag always goes to a folder of its own, by default named after its options
+OUTPUT_SUBDIR = None
+
+# Rough peak memory of one bag extraction on top of its image writer queue (bag chunks, decoded frames)
+BAG_WORKER_BYTES = 1 << 30
+
+# Write CompressedImage payloads straight to disk instead of decoding and re-encoding them
+COMPRESSED_PASSTHROUGH = True
+
+# Threads writing image files (0 writes them in the reading loop) and the most image data left waiting for them
+IMAGE_WRITERS = min(4, os.cpu_count() or 1)
+IMAGE_QUEUE_BYTES = 512 << 20
 
 # If we have an arg, override the root_directory variable
 parser = argparse.ArgumentParser()
 parser.add_argument('-p', '--path', type=str, default=root_directory, help='Path to rosbag files')
+parser.add_argument('--reencode', action='store_true',
+                    help='Decode and re-encode CompressedImage topics rather than writing their jpg/png bytes as is')
+parser.add_argument('--writers', type=int, default=IMAGE_WRITERS,
+                    help='Threads encoding and writing image files, 0 to write them while reading the bag')
+parser.add_argument('--writer-queue-mb', type=int, default=IMAGE_QUEUE_BYTES >> 20,
+                    help='Most image data (MB) queued for the writers before reading waits')
+parser.add_argument('-j', '--jobs', type=int, default=JOBS,
+                    help='Bags to extract in parallel, each in its own process logging to <bag folder>/logs/')
+parser.add_argument('--max-memory-gb', type=float, default=None,
+                    help='Memory the parallel jobs may use together, defaults to the memory available now')
+parser.add_argument('--chunk-jobs', type=int, default=CHUNK_JOBS,
+                    help='Split each bag into this many time ranges (along its chunks) extracted in parallel')
+parser.add_argument('--start', type=str, default=WINDOW_START,
+                    help='Extract from this bag time on, in seconds since the epoch or "+<seconds>" from the bag start')
+parser.add_argument('--end', type=str, default=WINDOW_END,
+                    help='Extract up to this bag time (inclusive), same format as --start')
+parser.add_argument('--every-nth', type=int, default=EVERY_NTH,
+                    help='Only extract every nth message of each topic')
+parser.add_argument('--max-rate', type=float, default=MAX_RATE,
+                    help='Only extract messages at most this often (Hz) per topic')
+parser.add_argument('--output-subdir', type=str, default=OUTPUT_SUBDIR,
+                    help='Write csv/, images/ and logs/ to this folder beside each bag.  Defaults to beside the bag, '
+                         'or for --start/--end/--every-nth/--max-rate to a folder named after them (e.g. start+600_end+660)')
 args = parser.parse_args()
 root_directory = args.path
+WINDOW_START = args.start
+WINDOW_END = args.end
+EVERY_NTH = args.every_nth
+MAX_RATE = args.max_rate
+OUTPUT_SUBDIR = args.output_subdir
+JOBS = args.jobs
+CHUNK_JOBS = args.chunk_jobs
+COMPRESSED_PASSTHROUGH = not args.reencode
+IMAGE_WRITERS = args.writers
+IMAGE_QUEUE_BYTES = args.writer_queue_mb << 20
+
+# Don't let a subset overwrite the frames and csvs of a full extraction
+if OUTPUT_SUBDIR is None :
+    subsetName = []
+    if WINDOW_START is not None :
+        subsetName.append('start' + WINDOW_START)
+    if WINDOW_END is not None :
+        subsetName.append('end' + WINDOW_END)
+    if EVERY_NTH > 1 :
+        subsetName.append('every' + str(EVERY_NTH))
+    if MAX_RATE is not None :
+        subsetName.append('rate' + format(MAX_RATE, 'g') + 'hz')
+    if subsetName :
+        OUTPUT_SUBDIR = '_'.join(subsetName).replace(os.sep, '-')
 
 # -------------------- Message functions --------------------
 
@@ -145,6 +226,16 @@ def indent_msg(msg, amt = 1):
 
 # ---------------------- Bag functions ----------------------
 
+def outputFolder(bagName) :
+    """
+    Folder the csv/, images/ and logs/ folders of a bag go in
+
+    :param bagName: bag file path
+    """
+    if OUTPUT_SUBDIR is None :
+        return os.path.dirname(bagName)
+    return os.path.join(os.path.dirname(bagName), OUTPUT_SUBDIR)
+
 def findBags(dir):
     """
     Find all bag files in current directory with BAGFILE_FORMAT
@@ -168,6 +259,7 @@ def extractBagDirectory(root_directory) :
 
     :param extractMethods: List of tuples of extraction functions and
                            corresponding name of files to be extracted
+    :return: list of bags that failed
     """
     bagNames = findBags(root_directory)
 
@@ -175,7 +267,7 @@ def extractBagDirectory(root_directory) :
     bagTotal = len(bagNames)
     if not bagNames:
         print(NO_BAG_MSG)
-        return
+        return []
     else:
         print(FOUND_BAG_MSG.format(bagTotal))
         for i in range(bagTotal):
@@ -183,42 +275,30 @@ def extractBagDirectory(root_directory) :
             print(COUNT.format(i+1, bagTotal, bagName))
         print()
 
-    if (RUN_IN_PARALLEL) :
-
-        print("Running job in parallel")
-        print("This could get messy...")
-
-        # Create a pool of worker processes
-        pool = multiprocessing.Pool()
-
-        # Map the process_bag function to each bag name in parallel
-        pool.map(process_bag, bagNames)
-
-        # Close the pool of worker processes
-        pool.close()
-        pool.join()
-
-    else :
-
-        # Process in series.  Easier to debug issues
-        counter = 1
-        for bagName in bagNames :
-            print(
-                "=============== Bag ", 
-                counter,
-                " of ",
-                bagTotal,
-                " ===============\n" )
-            print(f"\n{bagName}\n")
+    if (JOBS > 1) :
+        return extractBagsParallel(bagNames, JOBS)
+
+    # Process in series.  Easier to debug issues
+    counter = 1
+    failed = []
+    for bagName in bagNames :
+        print(
+            "=============== Bag ", 
+            counter,
+            " of ",
+            bagTotal,
+            " ===============\n" )
+        print(f"\n{bagName}\n")
+        try :
             process_bag(bagName)
-            counter = counter + 1
+        except Exception :
+            traceback.print_exc()
+            failed.append(bagName)
+        counter = counter + 1
 
-    return
+    return failed
 
 def process_bag(bagName) :
-        # Add the root_directory onto the bag name
-        bagName = os.path.join(root_directory,bagName)
-
         # Check the bag
         # bagName = checkBag(bagName)  # Slow and I don't think we need it.  We can reindex the bags elsewhere
 
@@ -227,10 +307,132 @@ def process_bag(bagName) :
             # Get a list of topics
             topics = bagFile.get_type_and_topic_info()
 
-            # Extract topics
-            imageExtract(bagFile, getWantedTopics(topics.topics,IMAGE_BAG_TOPICS))
-            gridmapExtract(bagFile, getWantedTopics(topics.topics,GRIDMAP_BAG_TOPICS))
-            csvExtract(bagFile, getWantedTopics(topics.topics,CSV_BAG_TOPICS))
+            imageTopics = getWantedTopics(topics.topics,IMAGE_BAG_TOPICS)
+            gridmapTopics = getWantedTopics(topics.topics,GRIDMAP_BAG_TOPICS)
+            csvTopics = getWantedTopics(topics.topics,CSV_BAG_TOPICS)
+
+            # Large bags can be split into time ranges read in parallel
+            if CHUNK_JOBS > 1 and len(bagFile._chunks) > 1 :
+                print("\tExtracting image, gridMap and csv data in up to " + str(CHUNK_JOBS) + " time ranges")
+                extractBagChunked(bagFile, CHUNK_JOBS, imageTopics, gridmapTopics, csvTopics)
+                return
+
+            # Work out what each topic feeds, then extract everything in a single read of the bag
+            print("\tExtracting image, gridMap and csv data")
+            with ImageWriter(IMAGE_WRITERS, IMAGE_QUEUE_BYTES) as imageWriter :
+                failed = demuxBag(bagFile, [
+                    imageSinks(bagFile, imageTopics, imageWriter),
+                    gridmapSinks(bagFile, gridmapTopics),
+                    csvSinks(bagFile, csvTopics),
+                ])
+
+            if failed :
+                raise RuntimeError("Topics failed: " + ', '.join(failed))
+
+# ---------------------- parallel extraction ----------------------
+
+GB = float(1 << 30)
+
+def bagLogPath(bagName) :
+    # <bag folder>/logs/<bag name>_extract.log, without .bag so it doesn't match BAGFILE_FORMAT
+    logName = re.sub(r'\.bag.*$', '', os.path.basename(bagName)) + '_extract.log'
+    return os.path.join(outputFolder(bagName), 'logs', logName)
+
+def availableMemory() :
+    # MemAvailable counts the page cache that can be reclaimed, which reading large bags fills up
+    try :
+        with open('/proc/meminfo', 'r') as f :
+            for line in f :
+                if line.startswith('MemAvailable:') :
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError) :
+        pass
+
+    # Free pages only, where there is no /proc/meminfo
+    try :
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError) :
+        return None
+
+def redirectOutput(logPath) :
+    # Send everything this process prints, including from ROS and OpenCV, to logPath
+    os.makedirs(os.path.dirname(logPath), exist_ok=True)
+    with open(logPath, 'w') as log :
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+    sys.stdout = sys.stderr = os.fdopen(1, 'w', buffering=1, closefd=False)
+
+def processBagLogged(bagName) :
+    """
+    Body of a bag worker process: extract one bag with everything it prints going to
+    its log file.  Exits non-zero if the extraction failed
+    """
+    redirectOutput(bagLogPath(bagName))
+
+    print(f"\n{bagName}\n")
+    try :
+        process_bag(bagName)
+    except Exception :
+        traceback.print_exc()
+        sys.stdout.flush()
+        os._exit(1)
+    sys.stdout.flush()
+    os._exit(0)
+
+def extractBagsParallel(bagNames, jobs) :
+    """
+    Extract bags in up to `jobs` worker processes, largest bags first so the longest
+    extractions don't start last.  Each worker logs to <bag folder>/logs/<bag>_extract.log and
+    a crashed or failing bag only loses that bag
+
+    :return: list of bags that failed
+    """
+    # Fewer jobs if they wouldn't all fit in memory
+    budget = args.max_memory_gb * GB if args.max_memory_gb is not None else availableMemory()
+    perBag = (BAG_WORKER_BYTES + IMAGE_QUEUE_BYTES) * max(1, CHUNK_JOBS)
+    if budget is not None and jobs * perBag > budget :
+        fitting = max(1, int(budget // perBag))
+        if fitting < jobs :
+            print(f"Limiting to {fitting} of {jobs} jobs, {budget/GB:.1f} GB of memory for ~{perBag/GB:.1f} GB per bag")
+            jobs = fitting
+
+    sizes = {bagName : os.path.getsize(bagName) for bagName in bagNames}
+    pending = sorted(bagNames, key=lambda bagName : sizes[bagName], reverse=True)
+    totalBytes = sum(sizes.values())
+
+    print(f"Extracting {len(bagNames)} bags with {jobs} jobs, logs in <bag folder>/logs/\n")
+
+    running = {}
+    failed = []
+    done = []
+    doneBytes = 0
+    start = time.time()
+
+    def showProgress() :
+        print('\x1b[1K\r' + f"Bags {len(done)}/{len(bagNames)} done, {len(running)} running, {len(failed)} failed"
+              f" | {doneBytes/GB:.1f}/{totalBytes/GB:.1f} GB | {time.time() - start:.0f} s", end='', flush=True)
+
+    while pending or running :
+        while pending and len(running) < jobs :
+            bagName = pending.pop(0)
+            proc = multiprocessing.Process(target=processBagLogged, args=(bagName,))
+            proc.start()
+            running[proc.sentinel] = (proc, bagName)
+
+        showProgress()
+        for sentinel in multiprocessing.connection.wait(list(running), timeout=5) :
+            proc, bagName = running.pop(sentinel)
+            proc.join()
+            done.append(bagName)
+            doneBytes += sizes[bagName]
+            if proc.exitcode != 0 :
+                failed.append(bagName)
+                print('\x1b[1K\r' + f"FAILED {bagName} (exit code {proc.exitcode}), see {bagLogPath(bagName)}")
+
+    showProgress()
+    print('\n')
+
+    return failed
 
 # ---------------------- rosbag check ----------------------
 # Fixes any bags that haven't closed properly
@@ -277,84 +479,189 @@ IMG_CSV_HEADERS = ['Time', \
                    'filename']
 
 FAILED_CSV_MSG = 'FAILED EXTRACTION of {}:'
-BAGPY_LOG_MSG = 'BAGPY READER LOG:'
 TOPIC_FOLDER_MSG = '{:<30} -> {}'
 
+# Message types that are not turned into csv files
+CSV_SKIP_TYPES = ['sensor_msgs/CompressedImage',
+                  'sensor_msgs/Image',
+                  'sensor_msgs/PointCloud2',
+                  'grid_map_msgs/GridMap',
+                  'tf2_msgs/TFMessage']
 
-def csvExtract(bagFile,topic_list):
+# Rows buffered per csv file between writes
+CSV_BATCH_ROWS = 4096
+CSV_BUFFER_BYTES = 1 << 20
+
+def leafPaths(msg, slot) :
     """
-    Convert messages of desired topics in a bag to a CSV
+    Dotted paths of the plain values under a slot, descending into sub-messages
+    (and time/duration stamps) the way bagpy's slotvalues does
 
-    :param bagName: filename of bag from which we want
-                    to extract topic messages
+    :param msg: ROS message (or sub-message)
+    :param slot: slot name
+    :return: list of paths, e.g. ['header.seq', 'header.stamp.secs', ...]
     """
+    value = getattr(msg, slot)
+    if not hasattr(value, '__slots__') :
+        return [slot]
+    return [slot + '.' + path for sub in value.__slots__ for path in leafPaths(value, sub)]
 
-    print("\tExtracting csv files")
+class MsgFlattener :
+    """
+    Column extractor for one message type, compiled once from the message's slots and field types.
+
+    Columns are laid out as bagpy's message_by_topic wrote them: dotted slot names, with top level
+    array fields that deserialize to tuples (e.g. covariances) spread over name_0, name_1, ...
+    """
+
+    def __init__(self, msg) :
+        self.paths = []
+        self.arrays = []
+        for slot, slotType in zip(msg.__slots__, msg._slot_types) :
+            paths = leafPaths(msg, slot)
+            if slotType.endswith(']') and len(paths) == 1 :
+                self.arrays.append(len(self.paths))
+            self.paths.extend(paths)
+
+        # A single C call fetching every column
+        getter = operator.attrgetter(*self.paths) if self.paths else (lambda msg : ())
+        self.getter = getter if len(self.paths) != 1 else (lambda msg : (getter(msg),))
+
+    def names(self, msg) :
+        names = list(self.paths)
+        values = self.getter(msg)
+        for i in reversed(self.arrays) :
+            value = values[i]
+            if isinstance(value, tuple) :
+                names[i:i + 1] = [names[i] + "_" + str(p) for p in range(len(value))]
+        return names
+
+    def values(self, msg) :
+        values = self.getter(msg)
+        if not self.arrays :
+            return list(values)
+
+        row = []
+        start = 0
+        for i in self.arrays :
+            row.extend(values[start:i])
+            if isinstance(values[i], tuple) :
+                row.extend(values[i])
+            else :
+                row.append(values[i])
+            start = i + 1
+        row.extend(values[start:])
+        return row
+
+# message type -> MsgFlattener
+MSG_FLATTENERS = {}
+
+def msgFlattener(msg) :
+    flattener = MSG_FLATTENERS.get(msg._type)
+    if flattener is None :
+        flattener = MSG_FLATTENERS[msg._type] = MsgFlattener(msg)
+    return flattener
+
+def partPath(path, part) :
+    # Where time range `part` of a chunked extraction writes the csv file `path`
+    return path if part is None else path + '.part{:03d}'.format(part)
+
+class CsvSink :
+    """
+    Writes the messages of one topic to a csv file, one flattened message per row
+    """
+
+    def __init__(self, topic, csvPath, part=None) :
+        self.topic = topic
+        self.csvPath = partPath(csvPath, part)
+        self.csvFile = None
+        self.csvWriter = None
+        self.flattener = None
+        self.rows = []
+
+    def write(self, msg, t) :
+        # Columns come from the first message.  Written to a temporary file so an
+        # interrupted extraction isn't mistaken for a finished one
+        if self.csvWriter is None :
+            self.flattener = msgFlattener(msg)
+            self.csvFile = open(self.csvPath + '.tmp', 'w', newline='', buffering=CSV_BUFFER_BYTES)
+            self.csvWriter = csv.writer(self.csvFile, delimiter=',')
+            self.csvWriter.writerow(['Time'] + self.flattener.names(msg))
+
+        row = self.flattener.values(msg)
+        row.insert(0, t.secs + t.nsecs*1e-9)
+        self.rows.append(row)
+        if len(self.rows) >= CSV_BATCH_ROWS :
+            self.flush()
+
+    def flush(self) :
+        self.csvWriter.writerows(self.rows)
+        self.rows = []
+
+    def close(self, failed=False) :
+        if self.csvFile is None :
+            print("\t\tNo data on the topic: " + self.topic)
+            return
+
+        self.flush()
+        self.csvFile.close()
+        if not failed :
+            shutil.move(self.csvPath + '.tmp', self.csvPath)
+
+def csvSinks(bagFile,topic_list,part=None) :
+    """
+    Create a csv sink for each csv-ish topic that hasn't been extracted yet
+
+    :param part: time range index when the bag is extracted in chunks
+    :return: dict of topic -> sink
+    """
+    sinks = {}
 
     # Create a folder for the data
-    extractFolder = os.path.join(os.path.dirname(bagFile.filename),'csv')
+    extractFolder = os.path.join(outputFolder(bagFile.filename),'csv')
 
     if (not os.path.exists(extractFolder)) :
         os.makedirs(extractFolder)
         print("\t\tCreated "+extractFolder)
 
-    print()
-    counter = 0
+    if topic_list is None :
+        return sinks
 
-    try:
+    topicTotal = len(topic_list)
+    topicTypes = bagFile.get_type_and_topic_info().topics
 
-        # Return if not topics to extract
-        if topic_list is None :
-            return
-        
-        topicTotal = len(topic_list)
-        
-        # Use bagpy to handle the CSV extraction
-        bagReader = bagpy.bagreader(bagFile.filename)
-
-        for topic in topic_list :
-
-            counter = counter+1
-            
-            # Check to make sure that we are extracting a csv-ish topic type
-            info = bagFile.get_type_and_topic_info(topic_filters=topic)
-            msg_type = info.topics[topic][0]
-            if (msg_type == 'sensor_msgs/CompressedImage') \
-                or (msg_type == 'sensor_msgs/Image') \
-                or (msg_type == 'sensor_msgs/PointCloud2') \
-                or (msg_type == 'grid_map_msgs/GridMap') \
-                or (msg_type == 'tf2_msgs/TFMessage') :
-                print(f"\tNot extracting {topic}, type {msg_type} as csv")
-                continue
+    for counter, topic in enumerate(topic_list, 1) :
 
-            # Generate all the names
-            csvName = topic.replace('/', '_') + CSV_EXT
-            csvNewPath = os.path.join(os.getcwd(), extractFolder, csvName)
-            
-            if (os.path.isfile(csvNewPath)) :
-                # No need to re-extract something that exists
-                print(COUNT.format(counter, topicTotal, topic + " > Already exists, skipping..."))
-                continue
+        # Check to make sure that we are extracting a csv-ish topic type
+        msg_type = topicTypes[topic].msg_type
+        if msg_type in CSV_SKIP_TYPES :
+            print(f"\tNot extracting {topic}, type {msg_type} as csv")
+            continue
 
-            # Extract the topic as csv
-            print( COUNT.format(counter, topicTotal, TOPIC_FOLDER_MSG.format(topic, csvNewPath)))
-            csvCurPath = bagReader.message_by_topic(topic)
-            shutil.move(csvCurPath, csvNewPath)
+        # Generate all the names
+        csvName = topic.replace('/', '_') + CSV_EXT
+        csvNewPath = os.path.join(os.getcwd(), extractFolder, csvName)
 
-    except Exception as e:
-        print(FAILED_CSV_MSG.format(topic))
-        print(e)
-    finally:
-        # Delete the temporary folder
-        if (os.path.isdir(os.path.splitext(bagFile.filename)[0])) :
-            shutil.rmtree(os.path.splitext(bagFile.filename)[0])
+        if (os.path.isfile(csvNewPath)) :
+            # No need to re-extract something that exists
+            print(COUNT.format(counter, topicTotal, topic + " > Already exists, skipping..."))
+            continue
 
-        # just in case (reader has no close method)
-        if 'bagReader' in locals():
-            del bagReader
+        print( COUNT.format(counter, topicTotal, TOPIC_FOLDER_MSG.format(topic, csvNewPath)))
+        sinks[topic] = CsvSink(topic, csvNewPath, part)
 
-    print() # newline for ending
-    return
+    return sinks
+
+def csvExtract(bagFile,topic_list):
+    """
+    Convert messages of desired topics in a bag to a CSV
+
+    :param bagFile: open bag from which we want to extract topic messages
+    :param topic_list: topics to extract
+    """
+
+    print("\tExtracting csv files")
+    demuxBag(bagFile, [csvSinks(bagFile, topic_list)])
 
 # ---------------------- image extract function ----------------------
 
@@ -363,311 +670,955 @@ IMG_COUNT = 'Frame '
 FAILED_IMG_MSG = 'STOPPING: failed extraction of frame {}'
 EXTRACT_FOLDER_MSG = '{:<10}: '
 
-def imageExtract(bagFile,topic_list):
+IMAGE_MSG_TYPES = ['sensor_msgs/CompressedImage', 'sensor_msgs/Image']
+
+# Image sinks save their progress beside their csv every this many frames, so an
+# interrupted extraction carries on from there instead of starting the topic again
+CHECKPOINT_FRAMES = 500
+CHECKPOINT_EXT = '.progress'
+
+# Raw sensor_msgs/Image encodings decoded without cv_bridge: encoding -> (dtype, channels)
+RAW_IMAGE_ENCODINGS = {
+    'mono8': (np.uint8, 1),
+    'mono16': (np.uint16, 1),
+    'bgr8': (np.uint8, 3),
+    'rgb8': (np.uint8, 3),
+    'bayer_rggb8': (np.uint8, 1),
+    'bayer_bggr8': (np.uint8, 1),
+    'bayer_gbrg8': (np.uint8, 1),
+    'bayer_grbg8': (np.uint8, 1),
+    'bayer_rggb16': (np.uint16, 1),
+    'bayer_bggr16': (np.uint16, 1),
+    'bayer_gbrg16': (np.uint16, 1),
+    'bayer_grbg16': (np.uint16, 1),
+}
+
+# ROS names bayer patterns from the top-left pixel, OpenCV from the second row's second pixel
+BAYER_TO_BGR = {
+    'rggb': cv2.COLOR_BayerBG2BGR,
+    'bggr': cv2.COLOR_BayerRG2BGR,
+    'gbrg': cv2.COLOR_BayerGR2BGR,
+    'grbg': cv2.COLOR_BayerGB2BGR,
+}
+
+def rawImage(msg) :
     """
-    Extract image image data from desired topics in a bag and create a CSV
-    documenting the timestamp for each image.
+    View a raw sensor_msgs/Image's data as an image array, without copying it.
+    Row padding (step larger than width) is skipped over with strides, only big
+    endian data is copied (byte swapped to native order)
 
-    :param bagName: filename of bag from which we want
-                    to extract EO data
+    :param msg: sensor_msgs/Image message
+    :return: image array (height x width [x channels]), None if the encoding isn't in RAW_IMAGE_ENCODINGS
     """
+    if msg.encoding not in RAW_IMAGE_ENCODINGS :
+        return None
 
-    print("\tExtracting image data")
+    dtype, channels = RAW_IMAGE_ENCODINGS[msg.encoding]
+    dtype = np.dtype(dtype).newbyteorder('>' if msg.is_bigendian else '<')
 
-    # Return if no topics to extract
-    if topic_list is None :
-        return
-        
-    topicTotal = len(topic_list)
+    shape = (msg.height, msg.width, channels)
+    strides = (msg.step, channels * dtype.itemsize, dtype.itemsize)
+    img = np.ndarray(shape, dtype, buffer=msg.data, strides=strides)
+    if channels == 1 :
+        img = img[:, :, 0]
 
-    # extract images using cv bridge
-    cvBridge = CvBridge()
-    try:
-        for i in range(topicTotal):
+    if not dtype.isnative :
+        img = img.astype(dtype.newbyteorder('='))
+    return img
 
-            topic = topic_list[i]
-            count = 0
+def passthroughExt(msg) :
+    """
+    File extension to write a CompressedImage's bytes under unchanged, if they can be
 
-            # Work out file paths/names
-            camera_name = ''
-            csvName   = topic.replace('/', '_') + CSV_EXT
-            csvFolder = os.path.join(os.path.dirname(bagFile.filename),'csv')
-            topicNameSplit = topic.split('/')
+    :param msg: sensor_msgs/CompressedImage message
+    :return: '.jpg' or '.png', None if the image needs decoding (bayer or other payloads)
+    """
+    # Raw bayer needs demosaicing and compressedDepth has its own header before the png
+    if 'bayer_rggb8' in msg.format or 'compressedDepth' in msg.format :
+        return None
+
+    # Trust the payload over the format string
+    if msg.data[:2] == b'\xff\xd8' :
+        return '.jpg'
+    if msg.data[:8] == b'\x89PNG\r\n\x1a\n' :
+        return '.png'
+    return None
+
+class PendingWrites :
+    """
+    Files of one sink still queued in the ImageWriter, so a sink can wait for its own
+    writes without stalling on the other topics'
+    """
 
-            # Work out folder names
-            imgFolder = os.path.join(os.path.dirname(bagFile.filename),'images')
-            for topic_part in topicNameSplit :
-                imgFolder = os.path.join(imgFolder,topic_part)
+    def __init__(self) :
+        self.n = 0
+        self.done = threading.Condition()
 
-            csvPath   = os.path.join(csvFolder, csvName)
+    def add(self) :
+        with self.done :
+            self.n += 1
 
-            # Check to make sure that we are an ok topic type
-            info = bagFile.get_type_and_topic_info(topic_filters=topic)
-            msg_type = info.topics[topic][0]
+    def remove(self) :
+        with self.done :
+            self.n -= 1
+            if self.n == 0 :
+                self.done.notify_all()
 
-            if (msg_type == 'sensor_msgs/CompressedImage') \
-                or (msg_type == 'sensor_msgs/Image') :
+    def wait(self) :
+        with self.done :
+            while self.n > 0 :
+                self.done.wait()
 
-                # These are known good message type, allow them
-                print("\t\tProcessing " + topic)
-                
-            elif (msg_type == 'dynamic_reconfigure/ConfigDescription') \
-                or (msg_type == 'dynamic_reconfigure/Config') \
-                or (msg_type == 'sensor_msgs/CameraInfo') \
-                or (msg_type == 'bond/Status') :
+class ImageWriter :
+    """
+    Threads writing image files for the image sinks, so reading the bag doesn't wait on jpg/tiff
+    encoding.  Files are named and logged by the sinks in bag order before being queued, and at
+    most maxBytes of image data waits in the queue (submit blocks until there is room)
+    """
 
-                # Known unsupported type, skip
-                # print("\t\t\tSkipping known non-image type message "+msg_type)
-                continue
+    def __init__(self, n_writers, maxBytes) :
+        self.maxBytes = maxBytes
+        self.queuedBytes = 0
+        self.room = threading.Condition()
+        self.jobs = queue.Queue()
+        self.threads = [threading.Thread(target=self.run, daemon=True) for _ in range(n_writers)]
+        for thread in self.threads :
+            thread.start()
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self, *exc) :
+        self.close()
+
+    @staticmethod
+    def write(path, img, errors) :
+        # img is either an image array to encode or already encoded bytes
+        try :
+            if isinstance(img, np.ndarray) :
+                if not cv2.imwrite(path, img) :
+                    raise IOError('cv2.imwrite failed')
+            else :
+                with open(path, 'wb') as f :
+                    f.write(img)
+        except Exception as e :
+            errors.append((path, e))
+
+    def run(self) :
+        while True :
+            job = self.jobs.get()
+            if job is None :
+                self.jobs.task_done()
+                return
+            path, img, errors, pending, size = job
+            self.write(path, img, errors)
+            pending.remove()
+            with self.room :
+                self.queuedBytes -= size
+                self.room.notify_all()
+            self.jobs.task_done()
+
+    def submit(self, path, img, errors, pending) :
+        """
+        Write an image array (encoded from the file extension) or encoded bytes to path
+
+        :param errors: list the (path, exception) of a failed write is appended to
+        :param pending: PendingWrites of the submitting sink, counts the file until it is written
+        """
+        if not self.threads :
+            self.write(path, img, errors)
+            return
 
+        size = img.nbytes if isinstance(img, np.ndarray) else len(img)
+        with self.room :
+            # A frame larger than the cap still goes through, on its own
+            while self.queuedBytes > 0 and self.queuedBytes + size > self.maxBytes :
+                self.room.wait()
+            self.queuedBytes += size
+        pending.add()
+        self.jobs.put((path, img, errors, pending, size))
+
+    def close(self) :
+        for _ in self.threads :
+            self.jobs.put(None)
+        for thread in self.threads :
+            thread.join()
+        self.threads = []
+
+class ImageSink :
+    """
+    Writes the messages of one image topic to images/<topic>/ as jpg (8-bit) or tiff (16-bit)
+    and a csv documenting the timestamp of each image
+    """
+
+    def __init__(self, bagFile, topic, imageWriter, part=None, offset=0) :
+        self.topic = topic
+        self.bagName = bagFile.filename
+        self.part = part
+        # Frame number of the first message (its index in the topic when extracting a time range)
+        self.offset = offset
+        self.count = offset
+        self.cvBridge = CvBridge()
+        self.imageWriter = imageWriter
+        self.writeErrors = []
+        self.pendingWrites = PendingWrites()
+
+        # Work out file paths/names
+        self.bagFolder = outputFolder(bagFile.filename)
+        self.csvFolder = os.path.join(self.bagFolder,'csv')
+        self.csvPath = os.path.join(self.csvFolder, topic.replace('/', '_') + CSV_EXT)
+
+        # Work out folder names
+        self.imgFolder = os.path.join(self.bagFolder,'images')
+        for topic_part in topic.split('/') :
+            self.imgFolder = os.path.join(self.imgFolder,topic_part)
+
+        self.csvFile = None
+        self.csvWriter = None
+
+        # Bag time (ns) of the last message handled, and how many were handled at that time,
+        # for the checkpoint.  When resuming, messages up to the checkpoint's are skipped
+        self.checkpointPath = self.csvPath + CHECKPOINT_EXT
+        self.lastTime = None
+        self.atLastTime = 0
+        self.resumeTime = None
+        self.resumeAtTime = 0
+
+    def isExtracted(self, n_images_expected) :
+        # Check the csv exists, then that the number of images extracted
+        # matches the number of messages in the bag file
+        if (os.path.exists(self.csvPath)) :
+            n_images_actual = len([file for file in os.listdir(self.imgFolder) if os.path.isfile(os.path.join(self.imgFolder, file))])
+            if (n_images_expected == n_images_actual) :
+                return True
+            print("\t\t\tImage count mismatch - re-extracting...")
+        return False
+
+    def checkpointKey(self) :
+        # What a checkpoint is only valid for: the same bag and the same selection of its messages
+        st = os.stat(self.bagName)
+        return {
+            'bag_size': st.st_size,
+            'bag_mtime_ns': st.st_mtime_ns,
+            'start': WINDOW_START,
+            'end': WINDOW_END,
+            'every_nth': EVERY_NTH,
+            'max_rate': MAX_RATE,
+            'passthrough': COMPRESSED_PASSTHROUGH,
+        }
+
+    def loadCheckpoint(self) :
+        """
+        The checkpoint left by an interrupted extraction of this topic
+
+        :return: dict of frames, time_ns, at_time and csv_bytes, None if there is nothing to resume
+        """
+        try :
+            with open(self.checkpointPath, 'r') as f :
+                checkpoint = json.load(f)
+        except (OSError, ValueError) :
+            return None
+
+        if checkpoint.get('key') != self.checkpointKey() :
+            return None
+        if not os.path.isfile(self.csvPath) or os.path.getsize(self.csvPath) < checkpoint['csv_bytes'] :
+            return None
+        return checkpoint
+
+    def saveCheckpoint(self) :
+        # Everything up to here must be on disk before the checkpoint says so.  Only this
+        # topic's writes are waited for, the other topics' keep going
+        self.csvFile.flush()
+        self.pendingWrites.wait()
+        if self.writeErrors :
+            return
+
+        checkpoint = {
+            'key': self.checkpointKey(),
+            'frames': self.count,
+            'time_ns': self.lastTime,
+            'at_time': self.atLastTime,
+            'csv_bytes': self.csvFile.tell(),
+        }
+        with open(self.checkpointPath + '.tmp', 'w') as f :
+            json.dump(checkpoint, f)
+        os.replace(self.checkpointPath + '.tmp', self.checkpointPath)
+
+    def open(self, resume=False) :
+        # Create the output folders if they don't exist
+        if (not os.path.exists(self.csvFolder)) :
+            os.makedirs(self.csvFolder)
+            print("\t\tCreated " + self.csvFolder)
+        
+        if (not os.path.exists(self.imgFolder)) :
+            os.makedirs(self.imgFolder)
+            print("\t\tCreated " + self.imgFolder)
+
+        checkpoint = self.loadCheckpoint() if resume else None
+        if checkpoint is not None :
+            # Carry on after the last checkpointed frame, dropping csv rows written since
+            os.truncate(self.csvPath, checkpoint['csv_bytes'])
+            self.csvFile = open(self.csvPath, 'a', newline='')
+            self.csvWriter = csv.writer(self.csvFile, delimiter=',')
+            self.offset = self.count = checkpoint['frames']
+            self.lastTime = self.resumeTime = checkpoint['time_ns']
+            self.atLastTime = self.resumeAtTime = checkpoint['at_time']
+            print("\t\t\tResuming from frame " + str(self.count))
+            return
+
+        # Start the csv file
+        self.csvFile = open(partPath(self.csvPath, self.part), 'w', newline='')
+        self.csvWriter = csv.writer(self.csvFile, delimiter=',')
+        self.csvWriter.writerow(IMG_CSV_HEADERS)
+
+    def decode(self, msg) :
+        if (msg._type == 'sensor_msgs/CompressedImage') :
+            cvImg = self.cvBridge.compressed_imgmsg_to_cv2(msg, desired_encoding="passthrough")
+
+            # Fix image encoding
+            if 'bayer_rggb8' in msg.format :
+                cvImg = cv2.cvtColor(cvImg,cv2.COLOR_BayerBG2BGR )
+        
+        elif (msg._type == 'sensor_msgs/Image') :
+            cvImg = rawImage(msg)
+            if cvImg is None :
+                cvImg = self.cvBridge.imgmsg_to_cv2(msg, desired_encoding="passthrough")
+
+            # Fix image encoding
+            if 'rgb8' in msg.encoding :
+                cvImg = cv2.cvtColor(cvImg,cv2.COLOR_RGB2BGR )
+            elif msg.encoding.startswith('bayer_') :
+                cvImg = cv2.cvtColor(cvImg,BAYER_TO_BGR[msg.encoding[6:10]])
+
+        else :
+            # Unknown not image type
+            print("Message type " + msg._type + " not supported!")
+            return None
+
+        return cvImg
+
+    def write(self, msg, t) :
+        t_ns = t.to_nsec()
+
+        # Messages up to the checkpoint were extracted before
+        if self.resumeTime is not None :
+            if t_ns < self.resumeTime :
+                return
+            if t_ns == self.resumeTime and self.resumeAtTime > 0 :
+                self.resumeAtTime -= 1
+                return
+            self.resumeTime = None
+
+        count = self.count
+        self.writeFrame(msg, t)
+
+        if t_ns == self.lastTime :
+            self.atLastTime += 1
+        else :
+            self.lastTime = t_ns
+            self.atLastTime = 1
+
+        if self.part is None and self.count != count and (self.count - self.offset) % CHECKPOINT_FRAMES == 0 :
+            self.saveCheckpoint()
+
+    def writeFrame(self, msg, t) :
+        cvImg = None
+        imgExt = None
+
+        # jpg/png payloads go to disk as they are
+        if (msg._type == 'sensor_msgs/CompressedImage' and COMPRESSED_PASSTHROUGH) :
+            imgExt = passthroughExt(msg)
+
+        if imgExt is None :
+            cvImg = self.decode(msg)
+
+            # Skip this round if no image imported
+            if cvImg is None :
+                return
+
+            # Extension type depends on data type for cvImg
+            if (cvImg.dtype == '<u2') :
+                # Thermal image
+                imgExt = '.tiff'
             else :
-                
-                # Known unsupported type, simply pass (good for debugging)
-                # print("\t\tTopic "+ topic +" of type "+msg_type+" is currently unsupported for image extract, skipping...")
-                continue
+                # Other images
+                imgExt = '.jpg'
+
+        imgName = 'image' + '-' + ('%05d' % self.count) + imgExt
+        imgFullName = os.path.join(self.imgFolder, imgName) 
+        self.imageWriter.submit(imgFullName, msg.data if cvImg is None else cvImg, self.writeErrors, self.pendingWrites)
+
+        imgRelativeName = imgFullName.replace(self.bagFolder,'')[1:]
+
+        # Write to CSV file
+        self.csvWriter.writerow( [
+            "{:.7f}".format(t.to_sec()), \
+            msg.header.seq, \
+            msg.header.stamp.secs, \
+            msg.header.stamp.nsecs, \
+            msg.header.frame_id, \
+            imgRelativeName])
+
+        # Update the counter
+        self.count += 1
+
+    def close(self, failed=False) :
+        if failed :
+            print(FAILED_IMG_MSG.format(self.count))
+
+        # Frames still queued are counted as extracted, make sure they are
+        self.pendingWrites.wait()
+        if self.writeErrors :
+            path, e = self.writeErrors[0]
+            print("\t\t" + self.topic + ": failed to write " + str(len(self.writeErrors)) + " frames, first " + path + ": " + str(e))
+
+        # A finished topic needs no checkpoint.  An unfinished one resumes from where it stopped,
+        # or after lost frames from the last checkpoint before them (saveCheckpoint keeps it)
+        if self.part is None :
+            if failed or self.writeErrors :
+                self.saveCheckpoint()
+            elif os.path.exists(self.checkpointPath) :
+                os.remove(self.checkpointPath)
+        self.csvFile.close()
+
+        print("\t\t" + self.topic + ": " + str(self.count - self.offset) + " frames")
+
+        # Frames in the csv that aren't on disk fail the topic
+        return len(self.writeErrors) > 0
+
+def imageSinks(bagFile,topic_list,imageWriter,part=None,offsets=None) :
+    """
+    Create an image sink for each image topic that hasn't been extracted yet
 
-            # Check to see if we've already extract images for this file.
-            # Check the csv exists, then that the number of images extracted
-            # matches the number of messages in the bag file
-            if (os.path.exists(csvPath)) :
-                n_images_expected = bagFile.get_message_count(topic_filters=topic)
-                n_images_actual = len([file for file in os.listdir(imgFolder) if os.path.isfile(os.path.join(imgFolder, file))])
-                if (n_images_expected == n_images_actual) :
-                    print("\t\t\tAlready extracted, skipping...")
-                    continue
-                if (n_images_expected != n_images_actual) :
-                    print("\t\t\tImage count mismatch - re-extracting...")
-
-            # Create the output folders if they don't exist
-            if (not os.path.exists(csvFolder)) :
-                os.makedirs(csvFolder)
-                print("\t\tCreated " + csvFolder)
-            
-            if (not os.path.exists(imgFolder)) :
-                os.makedirs(imgFolder)
-                print("\t\tCreated " + imgFolder)
-
-            # Start the csv file
-            csvFile = open(csvPath, 'w', newline='')
-            csvWriter = csv.writer(csvFile, delimiter=',')
-            csvWriter.writerow(IMG_CSV_HEADERS)
-
-            # Loop through and extract data
-            for topic, msg, t in bagFile.read_messages(topic):
-                if (msg._type == 'sensor_msgs/CompressedImage') :
-                    cvImg = cvBridge.compressed_imgmsg_to_cv2(msg, desired_encoding="passthrough")
-
-                    # Fix image encoding
-                    if 'bayer_rggb8' in msg.format :
-                        cvImg = cv2.cvtColor(cvImg,cv2.COLOR_BayerBG2BGR )
-                
-                elif (msg._type == 'sensor_msgs/Image') :
-                    cvImg = cvBridge.imgmsg_to_cv2(msg, desired_encoding="passthrough")
-
-                    # Fix image encoding
-                    if 'rgb8' in msg.encoding :
-                        cvImg = cv2.cvtColor(cvImg,cv2.COLOR_RGB2BGR )
-
-                else :
-                    # Unknown not image type
-                    print("Message type " + msg._type + " not supported!")
-                    print("\tSkipping " + topic)
-                    continue
-                
-                # Skip this round if no image imported
-                if cvImg is None :
-                    continue
+    :param imageWriter: ImageWriter the sinks queue their files on
+    :param part: time range index when the bag is extracted in chunks (topics are then
+                 already checked by pendingTopics)
+    :param offsets: dict of topic -> index of the range's first message in the topic
+    :return: dict of topic -> sink
+    """
+    sinks = {}
 
-                # Extension type depends on data type for cvImg
-                if (cvImg.dtype == '<u2') :
-                    # Thermal image
-                    imgExt = '.tiff'
-                else :
-                    # Other images
-                    imgExt = '.jpg'
+    # Return if no topics to extract
+    if topic_list is None :
+        return sinks
 
-                imgName = 'image' + '-' + ('%05d' % count) + imgExt
-                imgFullName = os.path.join(imgFolder, imgName) 
-                cv2.imwrite(imgFullName, cvImg)
+    topicTypes = bagFile.get_type_and_topic_info().topics
 
-                bagFolder = os.path.split(bagFile.filename)[0]
-                imgRelativeName = imgFullName.replace(bagFolder,'')[1:]
+    for topic in topic_list :
 
-                # Write to CSV file
-                csvWriter.writerow( [
-                    "{:.7f}".format(t.to_sec()), \
-                    msg.header.seq, \
-                    msg.header.stamp.secs, \
-                    msg.header.stamp.nsecs, \
-                    msg.header.frame_id, \
-                    imgRelativeName])
+        # Check to make sure that we are an ok topic type (known good message types).
+        # Anything else, e.g. CameraInfo or dynamic_reconfigure, is skipped
+        if topicTypes[topic].msg_type not in IMAGE_MSG_TYPES :
+            continue
 
-                # Print something so we know the process is happening
-                if (count % 100 == 0) :
-                    print('\x1b[1K\r\t\t\tFrame: '+str(count)+'/'+str(bagFile.get_message_count(topic))+' ',end='')
+        print("\t\tProcessing " + topic)
+        sink = ImageSink(bagFile, topic, imageWriter, part, offsets[topic] if offsets else 0)
 
-                # Update the counter
-                count += 1
+        # Check to see if we've already extract images for this file.  A checkpoint means the
+        # last run didn't finish it, even if every image is there (the csv tail may not be)
+        if part is None and sink.loadCheckpoint() is None and sink.isExtracted(messageCount(bagFile, topic)) :
+            print("\t\t\tAlready extracted, skipping...")
+            continue
 
-            csvFile.close()
+        sink.open(resume=part is None)
+        sinks[topic] = sink
 
-            print('\x1b[1K\r\t\t\tFrame: '+str(count)+'/'+str(bagFile.get_message_count(topic))+' ')
+    return sinks
 
-    except Exception as e:
-        print(FAILED_IMG_MSG.format(count))
-        print(e)
+def imageExtract(bagFile,topic_list):
+    """
+    Extract image image data from desired topics in a bag and create a CSV
+    documenting the timestamp for each image.
 
-    # All done :)
-    print()
-    return
+    :param bagFile: open bag from which we want to extract EO data
+    :param topic_list: topics to extract
+    """
+
+    print("\tExtracting image data")
+    with ImageWriter(IMAGE_WRITERS, IMAGE_QUEUE_BYTES) as imageWriter :
+        demuxBag(bagFile, [imageSinks(bagFile, topic_list, imageWriter)])
 
 # ---------------------- gridMap extract function ----------------------
+
+class GridmapSink :
+    """
+    Writes each layer of one gridMap topic as colour mapped images under images/<topic>/<layer>/
+    and a csv per layer documenting the timestamp of each image
+    """
+
+    def __init__(self, bagFile, topic, part=None, offset=0) :
+        self.topic = topic
+        self.part = part
+        self.n_messages = messageCount(bagFile, topic)
+        self.imgFolder = os.path.join(outputFolder(bagFile.filename),'images')
+        self.csvFolder = os.path.join(outputFolder(bagFile.filename),'csv')
+
+        # Total frame counter and image index counter (starting from the
+        # range's first message when extracting a time range)
+        self.frame_count = 0
+        self.imgName_index = offset
+
+        self.csvFiles = {}
+        self.done = False
+        # A chunked extraction checks before splitting the bag
+        self.checked = part is not None
+
+    def layerPaths(self, layer) :
+        # Work out the files and directory names/paths for images and csv files
+        topic_msg_layer = os.path.join(self.topic[1:], layer)
+        img_folder = os.path.join(self.imgFolder, topic_msg_layer)
+        csvName = self.topic.replace('/', '_')+'_' + layer + CSV_EXT
+        return img_folder, os.path.join(self.csvFolder, csvName)
+
+    def isExtracted(self, msg) :
+        # Check the csv of the first layer exists, then that the number of images
+        # extracted matches the number of messages in the bag file
+        if len(msg.layers) == 0 :
+            return False
+        img_folder, csvPath = self.layerPaths(msg.layers[0])
+        if (os.path.exists(csvPath)) :
+            n_images_actual = sum(1 for _, _, files in os.walk(img_folder) for f in files)
+            return self.n_messages == n_images_actual
+        return False
+
+    def write(self, msg, t) :
+        if self.done :
+            return
+
+        # Check to see if we've already extract images for this topic.
+        if not self.checked and len(msg.layers) > 0 :
+            self.checked = True
+            if self.isExtracted(msg) :
+                print("\t\t" + self.topic + ": Already extracted, skipping...")
+                self.done = True
+                return
+
+        # Loop through msg layers and extract layer data
+        for layer_count, layer in enumerate(msg.layers):
+
+            img_folder, csvPath = self.layerPaths(layer)
+
+            if layer not in self.csvFiles :
+                # Create the image subdirectories per layer
+                if not os.path.exists(img_folder):
+                    os.makedirs(img_folder)
+                    print("\n\t\tCreated " + img_folder, end='')
+
+                # Create csv directory
+                if not os.path.exists(self.csvFolder):
+                    os.makedirs(self.csvFolder)
+                    print("\n\t\tCreated " + self.csvFolder, end='')
+
+                # Add top row with headers if CSV file doesn't exist
+                csvPath = partPath(csvPath, self.part)
+                newCsv = not os.path.exists(csvPath)
+                csv_file = open(csvPath, 'a', newline='')
+                csv_writer = csv.writer(csv_file, delimiter=',')
+                if newCsv :
+                    csv_writer.writerow(IMG_CSV_HEADERS)
+                self.csvFiles[layer] = (csv_file, csv_writer)
+
+            # convert grid map to cv image
+            axis_length = int(np.sqrt(len(msg.data[layer_count].data)))
+            image_np = np.reshape(msg.data[layer_count].data, (axis_length, axis_length))
+            threshold_lo = np.percentile(image_np, 5)
+            threshold_hi = np.percentile(image_np, 95)
+            image_np[image_np < threshold_lo] = threshold_lo
+            image_np[image_np > threshold_hi] = threshold_hi
+            cv2.normalize(image_np, image_np, 0.0, 255.0, cv2.NORM_MINMAX)
+            image_np = np.uint8(image_np)
+            cvImg = cv2.applyColorMap(image_np, cv2.COLORMAP_MAGMA)
+
+            if cvImg.dtype == '<u2':
+                # Thermal image
+                imgExt = '.tiff'
+            else:
+                # Other images
+                imgExt = '.png'
+
+            # Work out the image name
+            imgName = 'image_' + str(self.imgName_index) + '_' + layer + imgExt
+            imgPath = os.path.join(img_folder, imgName)
+            cv2.imwrite(imgPath, cvImg)
+
+            # Write to CSV file
+            self.csvFiles[layer][1].writerow([
+                "{:.7f}".format(t.to_sec()), \
+                msg.info.header.seq, \
+                msg.info.header.stamp.secs, \
+                msg.info.header.stamp.nsecs, \
+                msg.info.header.frame_id, \
+                imgPath])
+
+            self.frame_count += 1
+
+        self.imgName_index += 1
+
+    def close(self, failed=False) :
+        if failed :
+            print(FAILED_IMG_MSG.format(self.frame_count))
+        for csv_file, _ in self.csvFiles.values() :
+            csv_file.close()
+        if not self.done :
+            print("\t\t" + self.topic + ": " + str(self.frame_count) + " layer frames")
+
+def gridmapSinks(bagFile,topic_list,part=None,offsets=None) :
+    """
+    Create a gridMap sink for each gridMap topic
+
+    :param part: time range index when the bag is extracted in chunks
+    :param offsets: dict of topic -> index of the range's first message in the topic
+    :return: dict of topic -> sink
+    """
+    sinks = {}
+
+    # If no topics, return
+    if topic_list is None :
+        return sinks
+
+    topicTypes = bagFile.get_type_and_topic_info().topics
+
+    for topic in topic_list:
+        # Only gridMap messages are supported
+        if topicTypes[topic].msg_type == 'grid_map_msgs/GridMap' :
+            print("\t\tProcessing " + topic)
+            sinks[topic] = GridmapSink(bagFile, topic, part, offsets[topic] if offsets else 0)
+
+    return sinks
+
 def gridmapExtract(bagFile,topic_list):
     """
     Extracts gridMap data from Image toics
     from ROS bag files.
 
-    :param bagName: 
-        -bag file name
+    :param bagFile: open bag file
+    :param topic_list: topics to extract
     """   
 
     print("\tExtracting gridMap data")
+    demuxBag(bagFile, [gridmapSinks(bagFile, topic_list)])
 
-    # If no topics, return functions
-    if topic_list is None :
-        return
-
-    # Extract gridmap using cv bridge
-    cvBridge = CvBridge()
+# ---------------------- single pass extraction ----------------------
 
-    imgFolder = os.path.join(os.path.dirname(bagFile.filename),'images')
-    csvFolder = os.path.join(os.path.dirname(bagFile.filename),'csv')
+def demuxBag(bagFile, sinkGroups, startTime=None, stopTime=None, n_messages=None) :
+    """
+    Read the bag once, in time order, handing each message to every sink
+    registered for its topic
+
+    :param bagFile: open bag file
+    :param sinkGroups: list of dicts of topic -> sink (e.g. image, gridMap and csv sinks)
+    :param startTime: only read messages from this bag time on
+    :param stopTime: only read messages before this bag time
+    :param n_messages: messages in the range, for the progress display
+    :return: list of topics whose sinks failed
+    """
+    sinks = {}
+    for group in sinkGroups :
+        for topic, sink in group.items() :
+            sinks.setdefault(topic, []).append(sink)
+
+    if len(sinks) == 0 :
+        print(NO_TOPICS_MSG.format(bagFile.filename))
+        return []
+
+    failed = set()
+    if n_messages is None :
+        n_messages = sum(messageCount(bagFile, topic) for topic in sinks)
+    count = 0
+
+    # When every sink resumes an interrupted extraction, start reading where the earliest left off
+    if startTime is None :
+        resumeTimes = [getattr(sink, 'resumeTime', None) for topicSinks in sinks.values() for sink in topicSinks]
+        if None not in resumeTimes :
+            resumeTime = min(resumeTimes)
+            startTime = genpy.Time(resumeTime // 1000000000, resumeTime % 1000000000)
+
+    if isSubset() :
+        messages = readSelected(bagFile, list(sinks), startTime, stopTime)
+    else :
+        messages = bagFile.read_messages(topics=list(sinks), start_time=startTime, end_time=stopTime)
 
-    try:
-        for topic in topic_list:
-            
-            # Check to make sure that we are an ok topic type
-            info = bagFile.get_type_and_topic_info(topic_filters=topic)
-            msg_type = info.topics[topic][0]
+    for topic, msg, t in messages :
+        # end_time is inclusive, messages at stopTime belong to the next range
+        if stopTime is not None and t >= stopTime :
+            break
 
-            if (msg_type == 'grid_map_msgs/GridMap') :
-                # These are known good message type, allow them
-                print("\t\tProcessing " + topic)
-            else :
-                # Known unsupported type, simply pass (good for debugging)
-                # print("\t\tTopic "+ topic +" of type "+msg_type+" is currently unsupported for gridmap message extract, skipping...")
+        for sink in sinks[topic] :
+            if sink in failed :
                 continue
-            
-            # Total frame counter    
-            frame_count = 0
-
-            # image index counter
-            imgName_index = 0
-
-            # Loop through topic msgs and extract gridMap data
-            for _, msg, t in bagFile.read_messages(topic):
-
-                # Loop through msg layers and extract layer data
-                for layer_count, layer in enumerate(msg.layers):
-                    
-                    # Make sure layer is an alphabetic and not numeric layer 
-                    # For example ['elevation'] is ok, but ['-1.570796'] is not.
-                    # matt: seems to work fine allowing numeric names here, so let's let it
-                    #       try and see what break (if it does in the future)
-                    if layer.replace('_', '').isalpha() or 1:
-
-                        # Work out the files and directory names/paths for images and csv files
-                        topic_msg_layer = os.path.join(topic[1:], layer)
-                        img_folder = os.path.join(imgFolder, topic_msg_layer)
-                        csvName = topic.replace('/', '_')+'_' + layer + CSV_EXT
-
-                        csvPath = os.path.join(csvFolder, csvName)
-                        
-                        # Check to see if we've already extract images for this file.
-                        # Check the csv exists, then that the number of images extracted
-                        # matches the number of messages in the bag file
-                        if (os.path.exists(csvPath)) :
-                            n_images_expected = bagFile.get_message_count(topic_filters=topic)
-                            n_images_actual = sum(1 for _, _, files in os.walk(img_folder) for f in files)
-                            if (n_images_expected == n_images_actual) :
-                                print("\t\tAlready extracted, skipping...")
-                                break
-                            if (n_images_expected != n_images_actual) :
-                                pass
-                                # print("\t\tImage count mismatch - re-extracting...")
-
-                        # Create the image subdirectories per layer
-                        if not os.path.exists(img_folder):
-                            os.makedirs(img_folder)
-                            print("\n\t\tCreated " + img_folder, end='')
-
-                        # Create csv directory
-                        if not os.path.exists(csvFolder):
-                            os.makedirs(csvFolder)
-                            print("\n\t\tCreated " + csvFolder, end='')
-
-                        # Add headers to csv file
-                        if not os.path.exists(csvPath):
-                            # Add top row with headers if CSV file doesn't exist
-                            with open(csvPath, 'w', newline='') as csv_file:
-                                csv_writer = csv.writer(csv_file)
-                                csv_writer.writerow(IMG_CSV_HEADERS)
-
-                        # convert grid map to cv image
-                        axis_length = int(np.sqrt(len(msg.data[layer_count].data)))
-                        image_np = np.reshape(msg.data[layer_count].data, (axis_length, axis_length))
-                        threshold_lo = np.percentile(image_np, 5)
-                        threshold_hi = np.percentile(image_np, 95)
-                        image_np[image_np < threshold_lo] = threshold_lo
-                        image_np[image_np > threshold_hi] = threshold_hi
-                        cv2.normalize(image_np, image_np, 0.0, 255.0, cv2.NORM_MINMAX)
-                        image_np = np.uint8(image_np)
-                        cvImg = cv2.applyColorMap(image_np, cv2.COLORMAP_MAGMA)
-
-                        if cvImg.dtype == '<u2':
-                            # Thermal image
-                            imgExt = '.tiff'
-                        else:
-                            # Other images
-                            imgExt = '.png'
-
-                        # Work out the image name
-                        imgName = 'image_' + str(imgName_index) + '_' + layer + imgExt
-                        imgPath = os.path.join(img_folder, imgName)
-                        cv2.imwrite(imgPath, cvImg)
-
-                        # Write to CSV file
-                        with open(csvPath, 'a', newline='') as csv_file:
-                            csv_writer = csv.writer(csv_file, delimiter=',')
-                            csv_writer.writerow([
-                                "{:.7f}".format(t.to_sec()), \
-                                msg.info.header.seq, \
-                                msg.info.header.stamp.secs, \
-                                msg.info.header.stamp.nsecs, \
-                                msg.info.header.frame_id, \
-                                imgPath])
-                    
-                    frame_count += 1
-
-                else:
-                    # This will execute if the inner loop completes normally (without breaking)
-                    imgName_index += 1
-                    # progress bar in form of frame counter
-                    if (frame_count % 100 == 0 and frame_count > 0) :
-                        print('\x1b[1K\r\t\t\tFrame: '+str(frame_count)+'/'+str(bagFile.get_message_count(topic)*len(msg.layers))+' ',end='')
+            try :
+                sink.write(msg, t)
+            except Exception as e :
+                # Stop feeding this sink, the others carry on
+                print(FAILED_CSV_MSG.format(topic))
+                print(e)
+                failed.add(sink)
+
+        # Print something so we know the process is happening
+        count += 1
+        if (count % 1000 == 0) :
+            print('\x1b[1K\r\t\tMessage: '+str(count)+'/'+str(n_messages)+' ',end='')
+
+    print('\x1b[1K\r\t\tMessage: '+str(count)+'/'+str(n_messages)+' ')
+
+    # A sink can still fail when closing, e.g. image files that couldn't be written
+    for topicSinks in sinks.values() :
+        for sink in topicSinks :
+            if sink.close(failed=sink in failed) :
+                failed.add(sink)
+
+    print() # newline for ending
+
+    return sorted(set(topic for topic, topicSinks in sinks.items() for sink in topicSinks if sink in failed))
+
+# ---------------------- time window and decimation ----------------------
+
+def isSubset() :
+    # Is only part of each topic extracted?
+    return WINDOW_START is not None or WINDOW_END is not None or EVERY_NTH > 1 or MAX_RATE is not None
+
+def bagTime(value, bagFile) :
+    """
+    --start/--end value as a bag time
+
+    :param value: seconds since the epoch, or '+<seconds>' from the start of the bag
+    """
+    if value is None :
+        return None
+    if value.startswith('+') :
+        return genpy.Time.from_sec(bagFile.get_start_time() + float(value[1:]))
+    return genpy.Time.from_sec(float(value))
+
+def windowTimes(bagFile) :
+    return bagTime(WINDOW_START, bagFile), bagTime(WINDOW_END, bagFile)
 
+# (bag file, topic) -> selected index entries
+SELECTED_ENTRIES = {}
+
+def selectedEntries(bagFile, topic) :
+    """
+    Index entries of the messages of a topic to extract, in time order: those in the
+    --start/--end window, thinned to every nth and to at most the max rate.  Worked out
+    from the bag's connection index alone, without reading any messages
+
+    :return: list of index entries (time, chunk_pos, offset)
+    """
+    key = (bagFile.filename, topic)
+    if key not in SELECTED_ENTRIES :
+        startTime, endTime = windowTimes(bagFile)
+        connections = list(bagFile._get_connections([topic], None))
+        minGap = None if MAX_RATE is None else int(1e9 / MAX_RATE)
+
+        entries = []
+        last = None
+        for k, entry in enumerate(bagFile._get_entries(connections, startTime, endTime)) :
+            if k % EVERY_NTH :
+                continue
+            if minGap is not None :
+                if last is not None and entry.time.to_nsec() - last < minGap :
                     continue
-                break  
+                last = entry.time.to_nsec()
+            entries.append(entry)
+        SELECTED_ENTRIES[key] = entries
+
+    return SELECTED_ENTRIES[key]
+
+def messageCount(bagFile, topic) :
+    # Messages of the topic that get extracted
+    if isSubset() :
+        return len(selectedEntries(bagFile, topic))
+    return bagFile.get_message_count(topic_filters=topic)
+
+def readSelected(bagFile, topics, startTime=None, stopTime=None) :
+    """
+    Read the selected messages of topics in time order, seeking to each through the
+    index so only the chunks holding them are read (and decompressed)
+
+    :param startTime: skip messages before this bag time
+    :param stopTime: stop before this bag time
+    :return: iterator of (topic, msg, t) as from read_messages
+    """
+    selections = []
+    for topic in topics :
+        entries = selectedEntries(bagFile, topic)
+        times = [entry.time for entry in entries]
+        lo = 0 if startTime is None else bisect.bisect_left(times, startTime)
+        hi = len(entries) if stopTime is None else bisect.bisect_left(times, stopTime)
+        selections.append(entries[lo:hi])
+
+    for entry in heapq.merge(*selections, key=lambda entry : entry.time.to_nsec()) :
+        yield bagFile._reader.seek_and_read_message_data_record((entry.chunk_pos, entry.offset), False)
+
+# ---------------------- chunk parallel extraction ----------------------
+
+def pendingTopics(bagFile, imageTopics, gridmapTopics, csvTopics) :
+    """
+    The topics of each kind still to be extracted, checked once up front as the chunk
+    workers can't tell an earlier extraction from each other's output
+
+    :return: image, gridMap and csv topics
+    """
+    topicTypes = bagFile.get_type_and_topic_info().topics
+
+    images = []
+    for topic in imageTopics :
+        if topicTypes[topic].msg_type not in IMAGE_MSG_TYPES :
+            continue
+        sink = ImageSink(bagFile, topic, None)
+        if sink.loadCheckpoint() is None and sink.isExtracted(messageCount(bagFile, topic)) :
+            print("\t\t" + topic + ": Already extracted, skipping...")
+            continue
+        images.append(topic)
+
+    gridmaps = []
+    for topic in gridmapTopics :
+        if topicTypes[topic].msg_type != 'grid_map_msgs/GridMap' :
+            continue
+        for _, msg, _ in bagFile.read_messages(topics=[topic]) :
+            if GridmapSink(bagFile, topic).isExtracted(msg) :
+                print("\t\t" + topic + ": Already extracted, skipping...")
+            else :
+                gridmaps.append(topic)
+            break
+
+    csvFolder = os.path.join(outputFolder(bagFile.filename),'csv')
+    csvs = [topic for topic in csvTopics if topicTypes[topic].msg_type not in CSV_SKIP_TYPES and
+            not os.path.isfile(os.path.join(csvFolder, topic.replace('/', '_') + CSV_EXT))]
+
+    return images, gridmaps, csvs
+
+def chunkRanges(bagFile, n) :
+    """
+    Split the bag (or the --start/--end window of it) into up to n time ranges holding
+    about the same number of chunks, starting where chunks start
+
+    :return: list of (startTime, stopTime), None for the bag's start and end
+    """
+    startTime, endTime = windowTimes(bagFile)
+    starts = sorted(chunk.start_time for chunk in bagFile._chunks
+                    if (startTime is None or chunk.end_time >= startTime) and (endTime is None or chunk.start_time <= endTime))
+    if not starts :
+        return [(None, None)]
+    bounds = sorted(set(starts[len(starts) * k // n] for k in range(1, n)))
+    bounds = [bound for bound in bounds if bound > starts[0]]
+    return list(zip([None] + bounds, bounds + [None]))
+
+def topicOffsets(bagFile, topics, ranges) :
+    """
+    Index in its topic of the first message of each range, from the bag's message index
+    (counting only the messages selected for extraction)
+
+    :return: list (per range) of dicts of topic -> offset, and the message count of each range
+    """
+    times = {topic : [entry.time for entry in selectedEntries(bagFile, topic)] for topic in topics}
+
+    offsets = [{} for _ in ranges]
+    for topic, topicTimes in times.items() :
+        for k, (startTime, _) in enumerate(ranges) :
+            offsets[k][topic] = 0 if startTime is None else bisect.bisect_left(topicTimes, startTime)
 
-            print('\x1b[1K\r\t\t\tFrame: '+str(frame_count)+'/'+str(bagFile.get_message_count(topic)*len(msg.layers))+' ')
+    total = sum(len(topicTimes) for topicTimes in times.values())
+    counts = [sum(offsets[k + 1].values()) - sum(offsets[k].values()) for k in range(len(ranges) - 1)]
+    counts.append(total - sum(offsets[-1].values()))
+    return offsets, counts
 
-    except Exception as e:
-        print(FAILED_IMG_MSG.format(frame_count))
-        print(e)
+def chunkLogPath(bagName, part) :
+    return os.path.splitext(bagLogPath(bagName))[0] + '_chunk{:03d}.log'.format(part)
 
-    # newline for ending
-    print()
-    return
+def extractChunk(bagName, part, timeRange, offsets, n_messages, imageTopics, gridmapTopics, csvTopics) :
+    """
+    Body of a chunk worker process: extract one time range of a bag to the part files of
+    its csvs and the final image names.  Exits non-zero if anything failed
+    """
+    redirectOutput(chunkLogPath(bagName, part))
+
+    print(f"\n{bagName} time range {part}: {timeRange[0]} - {timeRange[1]}\n")
+    try :
+        # Its own handle, the parent's file position isn't ours to move
+        with rosbag.Bag(bagName,'r') as bagFile :
+            with ImageWriter(IMAGE_WRITERS, IMAGE_QUEUE_BYTES) as imageWriter :
+                failed = demuxBag(bagFile, [
+                    imageSinks(bagFile, imageTopics, imageWriter, part, offsets),
+                    gridmapSinks(bagFile, gridmapTopics, part, offsets),
+                    csvSinks(bagFile, csvTopics, part),
+                ], timeRange[0], timeRange[1], n_messages)
+    except Exception :
+        traceback.print_exc()
+        failed = True
+    sys.stdout.flush()
+    os._exit(1 if failed else 0)
+
+def csvParts(csvFolder) :
+    # final csv path -> its part files in range order
+    parts = {}
+    for path in sorted(glob.glob(os.path.join(csvFolder, '*' + CSV_EXT + '.part[0-9][0-9][0-9]'))) :
+        parts.setdefault(path.rsplit('.part', 1)[0], []).append(path)
+    return parts
+
+def mergeCsvParts(csvFolder) :
+    """
+    Join the part files of each csv, keeping the header of the first one only
+    """
+    for csvPath, parts in csvParts(csvFolder).items() :
+        with open(csvPath + '.tmp', 'wb') as out :
+            header = True
+            for part in parts :
+                with open(part, 'rb') as f :
+                    if not header :
+                        f.readline()
+                    shutil.copyfileobj(f, out)
+                header = False
+        shutil.move(csvPath + '.tmp', csvPath)
+        for part in parts :
+            os.remove(part)
+
+def extractBagChunked(bagFile, n, imageTopics, gridmapTopics, csvTopics) :
+    """
+    Extract a bag as up to n time ranges in parallel processes, split along its chunk
+    index.  Frames are numbered from the message offsets of each range and the csv parts
+    are merged in order, so the output is laid out as from a single read of the bag
+    """
+    bagName = bagFile.filename
+    csvFolder = os.path.join(outputFolder(bagName),'csv')
+
+    # Parts left by an interrupted run
+    for parts in csvParts(csvFolder).values() :
+        for part in parts :
+            os.remove(part)
+
+    imageTopics, gridmapTopics, csvTopics = pendingTopics(bagFile, imageTopics, gridmapTopics, csvTopics)
+    if not (imageTopics or gridmapTopics or csvTopics) :
+        print(NO_TOPICS_MSG.format(bagName))
+        return
+
+    ranges = chunkRanges(bagFile, n)
+    offsets, counts = topicOffsets(bagFile, imageTopics + gridmapTopics + csvTopics, ranges)
+    print(f"\t\t{len(ranges)} time ranges of {', '.join(str(count) for count in counts)} messages, logs in " + os.path.dirname(bagLogPath(bagName)))
+
+    procs = []
+    for part, timeRange in enumerate(ranges) :
+        proc = multiprocessing.Process(target=extractChunk, args=(bagName, part, timeRange, offsets[part], counts[part],
+                                                                  imageTopics, gridmapTopics, csvTopics))
+        proc.start()
+        procs.append(proc)
+
+    failed = []
+    for part, proc in enumerate(procs) :
+        proc.join()
+        if proc.exitcode != 0 :
+            failed.append(chunkLogPath(bagName, part))
+
+    if failed :
+        raise RuntimeError("Time ranges failed, see " + ', '.join(failed))
+
+    mergeCsvParts(csvFolder)
+    print("\t\tMerged the csv files of " + str(len(ranges)) + " time ranges")
+
+    # Image topics were extracted whole, a checkpoint of an earlier serial run no longer applies
+    for topic in imageTopics :
+        checkpointPath = ImageSink(bagFile, topic, None).checkpointPath
+        if os.path.exists(checkpointPath) :
+            os.remove(checkpointPath)
 
 # ----------------------  EXTRACTION  ----------------------
 
@@ -678,9 +1629,17 @@ def main():
     print('=' * len(str))
     print(str)
     print('=' * len(str))
+    if OUTPUT_SUBDIR is not None :
+        print("Writing to <bag folder>/" + OUTPUT_SUBDIR + "/")
     print("\n\n")
 
-    extractBagDirectory(root_directory)
+    failed = extractBagDirectory(root_directory)
+
+    if failed :
+        print(f"\n{len(failed)} bags failed:")
+        for bagName in failed :
+            print("\t" + bagName)
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
@@ -1,6 +1,7 @@
 #!/bin/bash
 
 # A script for cutting down bag files
+#   To extract a window without writing a cut bag, use rosbagExtract.py --start/--end instead
 
 rosbag filter flight1.bag flight1-cut.bag "t.secs >= 1671565228 and t.secs <= 1671566047"
 rosbag filter flight2.bag flight2-cut.bag "t.secs >= 1671567362 and t.secs <= 1671568196"
@@ -0,0 +1,51 @@
+import argparse
+import glob
+import os
+
+import cv2
+import tqdm
+
+from stereo_rectify import PAIR_TYPES, VIEW_PRODUCTS, output_paths, render_sxs, render_overlay
+
+
+RENDERERS = {
+    'sxs': render_sxs,
+    'overlay': render_overlay,
+}
+
+
+def render_views(output_dir, views=VIEW_PRODUCTS, overwrite=False):
+    # Render side-by-side / overlay images from the rectified thermal8 and eo images stored by stereo_rectify.py
+    for pair_type in PAIR_TYPES:
+        thermal8_paths = sorted(glob.glob(os.path.join(output_dir, pair_type, 'thermal8', '*.png')))
+        if not thermal8_paths:
+            continue
+
+        for view in views:
+            os.makedirs(os.path.join(output_dir, pair_type, view), exist_ok=True)
+
+        for thermal8_path in tqdm.tqdm(thermal8_paths, desc=pair_type):
+            save_paths = output_paths(thermal8_path, pair_type, output_dir)
+            todo = [view for view in views if overwrite or not os.path.isfile(save_paths[view])]
+            if not todo or not os.path.isfile(save_paths['eo']):
+                continue
+
+            thermal8_img = cv2.imread(thermal8_path, cv2.IMREAD_COLOR)
+            eo_img = cv2.imread(save_paths['eo'], cv2.IMREAD_COLOR)
+            for view in todo:
+                cv2.imwrite(save_paths[view], RENDERERS[view](thermal8_img, eo_img))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Render viewing images from stored stereo rectified pairs')
+    parser.add_argument('--output_dir', type=str, required=True, help='output_dir given to stereo_rectify.py')
+    parser.add_argument('--views', type=str, default=','.join(VIEW_PRODUCTS))
+    parser.add_argument('--overwrite', action='store_true')
+    args = parser.parse_args()
+
+    views = [view for view in args.views.split(',') if view]
+    if not views or set(views) - set(VIEW_PRODUCTS):
+        parser.error('--views must be a comma separated subset of {}'.format(','.join(VIEW_PRODUCTS)))
+
+    render_views(args.output_dir, views, args.overwrite)
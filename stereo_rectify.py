@@ -1,133 +1,438 @@
 import argparse
+import functools
 import os
 
 import cv2
 import numpy as np
 import pandas as pd
-from utils.rectifier import StereoRectifier
-from utils.autoscale import raw16bit_to_32FC_autoScale
+from utils.rectifier import StereoRectifier, calibration_file_hash
+from utils.autoscale import raw16bit_to_32FC_autoScale, StreamingAutoScaler, CLAHE_BACKENDS, DEFAULT_CLAHE_BACKEND
+from utils.pipeline import Pipeline
+from utils.manifest import Manifest, file_fingerprint
+from utils.shards import ShardWriter, DEFAULT_SHARD_BYTES
+from utils.sync import synchronize
 import tqdm
 
-from joblib import Parallel, delayed
-
-
-def synchronize_df(thermal_sync_csv, mono_sync_csv, color_sync_csv):
-    sync_df = pd.read_csv(thermal_sync_csv)
-    sync_df.rename(columns={'filename': 'thermal_filepath'}, inplace=True)
-
-    mono_df = pd.read_csv(mono_sync_csv)
-    mono_df.rename(columns={'filename': 'mono_filepath'}, inplace=True)
-    sync_df = pd.merge_asof(
-        sync_df,
-        mono_df,
-        left_on='Time',
-        right_on='Time',
-        direction="nearest",
-        tolerance=1 / 60
-    )
-
-    color_df = pd.read_csv(color_sync_csv)
-    color_df.rename(columns={'filename': 'color_filepath'}, inplace=True)
-    sync_df = pd.merge_asof(
-        sync_df,
-        color_df,
-        left_on='Time',
-        right_on='Time',
-        direction="nearest",
-        tolerance=1 / 60
-    )
+
+PAIR_TYPES = ['thermal_mono', 'thermal_color']
+PRODUCTS = ['thermal', 'thermal8', 'eo', 'sxs', 'overlay']
+SINKS = ['files', 'shards']
+SYNC_TOLERANCE = 1 / 60
+
+# Viewing aids, can be rendered later from stored thermal8 and eo images (see render_views.py)
+VIEW_PRODUCTS = ['sxs', 'overlay']
+
+
+def synchronize_df(thermal_sync_csv, mono_sync_csv, color_sync_csv, tolerance=SYNC_TOLERANCE, sidecar_dir=None):
+    # Nearest mono and color frame for every thermal frame, NaN where none is within tolerance
+    sync = synchronize([thermal_sync_csv, mono_sync_csv, color_sync_csv], reference=0, tolerance=tolerance,
+                       direction='nearest', sidecar_dir=sidecar_dir)
+
+    sync_df = pd.DataFrame({'Time': sync.times})
+    for k, column in enumerate(['thermal_filepath', 'mono_filepath', 'color_filepath']):
+        sync_df[column] = sync.matched_filenames(k)
+    return sync_df.fillna(value=np.nan)
+
+
+def thermal_autoscale_cutoffs(data_dir, sync_df, stats_path, alpha):
+    # Temporally smoothed autoscale cutoffs for every thermal frame of the trajectory, in time order.
+    # Per-frame statistics already in stats_path are reused, new ones are saved back for the next run
+    scaler = StreamingAutoScaler.load_or_create(stats_path, alpha=alpha)
+    n_known = len(scaler.stats)
+
+    cutoffs = []
+    for thermal_filepath in tqdm.tqdm(sync_df['thermal_filepath'], desc='Thermal statistics'):
+        thermal_img = None
+        if thermal_filepath not in scaler.stats:
+            thermal_img = cv2.imread(os.path.join(data_dir, thermal_filepath), -1)
+        cutoffs.append(scaler.update(thermal_img, key=thermal_filepath))
+
+    if len(scaler.stats) > n_known:
+        scaler.save(stats_path)
+
+    sync_df = sync_df.copy()
+    sync_df['thermal_lo'], sync_df['thermal_hi'] = zip(*cutoffs)
     return sync_df
 
 
-def process_thermal_eo_pair(thermal_img_path, eo_img_path):
-    thermal_img = cv2.imread(thermal_img_path, -1)
-    eo_img = cv2.imread(eo_img_path, 1)
+def normalize_thermal_img(thermal_img, clahe_backend=DEFAULT_CLAHE_BACKEND, cutoffs=None):
+    # The percentiles come from a single histogram of the frame. Round to 8-bit here (as imwrite would)
+    # so the normalized image can be remapped and blended with the 8-bit EO image
+    thermal_img_normalized = raw16bit_to_32FC_autoScale(
+        thermal_img, equalize_hist=True, clahe_backend=clahe_backend, cutoffs=cutoffs)
+    thermal_img_normalized = np.rint(thermal_img_normalized).astype(np.uint8)
+    return np.stack([thermal_img_normalized] * 3, axis=2)
+
 
+def thermal_eo_offset(thermal_img, eo_img):
     H, W, C = eo_img.shape
     tH, tW = thermal_img.shape
 
-    thermal_img_normalized = raw16bit_to_32FC_autoScale(
-        thermal_img, [np.percentile(thermal_img, 2), np.percentile(thermal_img, 98)])
-    thermal_img_normalized = np.stack([thermal_img_normalized] * 3, axis=2)
-
+    # The thermal image is centred in the EO sized frame the calibration assumes. Rather than padding
+    # it, the offset is handed to the rectifier and baked into its remap tables
     pad_w = int((W - tW) / 2)
     pad_h = int((H - tH) / 2)
-    thermal_img = cv2.copyMakeBorder(thermal_img, pad_h, pad_h, pad_w, pad_w, cv2.BORDER_CONSTANT, None, 0)
-    thermal_img_normalized = cv2.copyMakeBorder(
-        thermal_img_normalized, pad_h, pad_h, pad_w, pad_w, cv2.BORDER_CONSTANT, None, 0)
+    return pad_w, pad_h
+
+
+def output_paths(thermal_img_path, pair_type, output_dir):
+    thermal_name = os.path.basename(thermal_img_path)
+    png_name = thermal_name.replace('.tiff', '.png')
+
+    return {
+        'thermal': os.path.join(output_dir, pair_type, 'thermal', thermal_name),
+        'thermal8': os.path.join(output_dir, pair_type, 'thermal8', png_name),
+        'eo': os.path.join(output_dir, pair_type, 'eo', png_name.replace('thermal', 'eo')),
+        'sxs': os.path.join(output_dir, pair_type, 'sxs', png_name.replace('thermal', 'sxs')),
+        'overlay': os.path.join(output_dir, pair_type, 'overlay', png_name.replace('thermal', 'overlay')),
+    }
+
+
+def shard_members(thermal_img_path, pair_type):
+    # Member names when the outputs are packed into shards, one group of products per pair
+    stem = os.path.splitext(os.path.basename(thermal_img_path))[0]
+    return {
+        product: '{}/{}.{}.{}'.format(pair_type, stem, product, 'tiff' if product == 'thermal' else 'png')
+        for product in PRODUCTS
+    }
+
+
+def make_output_dirs(output_dir, products=PRODUCTS):
+    for pair_type in PAIR_TYPES:
+        for product in products:
+            os.makedirs(os.path.join(output_dir, pair_type, product), exist_ok=True)
+
 
-    return thermal_img, eo_img, thermal_img_normalized
+def render_sxs(thermal8_img_rect, eo_img_rect):
+    return np.hstack([thermal8_img_rect, eo_img_rect])
 
 
-def stereo_rectify_helper(sr, thermal_img_path, eo_img_path, pair_type, output_dir, rotate180=False):
+def render_overlay(thermal8_img_rect, eo_img_rect):
+    return cv2.addWeighted(eo_img_rect, 0.4, thermal8_img_rect, 0.5, 0)
 
-    assert pair_type in ['thermal_mono', 'thermal_color'], 'pair_type must be either thermal_mono or thermal_color'
 
-    # Create directories
-    thermal16_dir = os.path.join(output_dir, pair_type, 'thermal')
-    thermal8_dir = os.path.join(output_dir, pair_type, 'thermal8')
+def rectify_thermal_eo_pair(sr, thermal_img, eo_img, pair_type, rotate180=False,
+                            clahe_backend=DEFAULT_CLAHE_BACKEND, cutoffs=None, products=PRODUCTS, thermal8_img=None):
+    # Returns the requested products only. Anything no requested product depends on (normalization,
+    # remaps, blending) is never computed. thermal8_img, if given, is the already normalized thermal_img
 
-    eo_dir = os.path.join(output_dir, pair_type, 'eo')
-    sxs_dir = os.path.join(output_dir, pair_type, 'sxs')
-    overlay_dir = os.path.join(output_dir, pair_type, 'overlay')
+    assert pair_type in PAIR_TYPES, 'pair_type must be either thermal_mono or thermal_color'
 
-    os.makedirs(thermal16_dir, exist_ok=True)
-    os.makedirs(thermal8_dir, exist_ok=True)
+    products = set(products)
+    needs_thermal8 = bool(products & {'thermal8', 'sxs', 'overlay'})
+    needs_eo = bool(products & {'eo', 'sxs', 'overlay'})
 
-    os.makedirs(eo_dir, exist_ok=True)
-    os.makedirs(sxs_dir, exist_ok=True)
-    os.makedirs(overlay_dir, exist_ok=True)
+    # Thermal is cam0 of the thermal_mono calibration and cam1 of the color_thermal one.
+    # Padding and the optional 180 degree rotation are part of the warp, one remap per output
+    thermal_cam, eo_cam = (0, 1) if pair_type == 'thermal_mono' else (1, 0)
+    thermal_offset = thermal_eo_offset(thermal_img, eo_img)
 
-    # Process image pair
-    thermal_img, eo_img, thermal_img_normalized = process_thermal_eo_pair(thermal_img_path, eo_img_path)
+    thermal_imgs = {}
+    if 'thermal' in products:
+        thermal_imgs['thermal'] = thermal_img
+    if needs_thermal8:
+        if thermal8_img is None:
+            thermal8_img = normalize_thermal_img(thermal_img, clahe_backend, cutoffs)
+        thermal_imgs['thermal8'] = thermal8_img
 
-    if pair_type == 'thermal_mono':
-        thermal_img_rect, _ = sr.rectify_img_pair(thermal_img, eo_img)
-        thermal_img_normalized_rect, eo_img_rect = sr.rectify_img_pair(thermal_img_normalized, eo_img)
-    elif pair_type == 'thermal_color':
-        _, thermal_img_rect = sr.rectify_img_pair(eo_img, thermal_img)
-        eo_img_rect, thermal_img_normalized_rect = sr.rectify_img_pair(eo_img, thermal_img_normalized)
+    rectified = dict(zip(thermal_imgs, sr.rectify_imgs(
+        thermal_cam, *thermal_imgs.values(), src_offset=thermal_offset, rotate_180=rotate180)))
+    if needs_eo:
+        rectified['eo'], = sr.rectify_imgs(eo_cam, eo_img, rotate_180=rotate180)
 
-    if rotate180:
-        eo_img_rect = cv2.rotate(eo_img_rect, cv2.ROTATE_180)
-        thermal_img_rect = cv2.rotate(thermal_img_rect, cv2.ROTATE_180)
-        thermal_img_normalized_rect = cv2.rotate(thermal_img_normalized_rect, cv2.ROTATE_180)
+    if 'sxs' in products:
+        rectified['sxs'] = render_sxs(rectified['thermal8'], rectified['eo'])
+    if 'overlay' in products:
+        rectified['overlay'] = render_overlay(rectified['thermal8'], rectified['eo'])
 
-    thermal_eo_sxs = np.hstack([thermal_img_normalized_rect, eo_img_rect])
-    thermal_eo_overlay = cv2.addWeighted(eo_img_rect, 0.4, thermal_img_normalized_rect, 0.5, 0)
+    return {product: rectified[product] for product in PRODUCTS if product in products}
 
-    thermal_img_save_path = os.path.join(thermal16_dir, os.path.basename(thermal_img_path))
-    thermal8_save_path = os.path.join(thermal8_dir, os.path.basename(thermal_img_path).replace('.tiff', '.png'))
-    eo_save_path = os.path.join(eo_dir, os.path.basename(
-        thermal_img_path).replace('.tiff', '.png').replace('thermal', 'eo'))
-    sxs_save_path = os.path.join(sxs_dir, os.path.basename(
-        thermal_img_path).replace('.tiff', '.png').replace('thermal', 'sxs'))
-    overlay_save_path = os.path.join(overlay_dir, os.path.basename(
-        thermal_img_path).replace('.tiff', '.png').replace('thermal', 'overlay'))
 
-    cv2.imwrite(thermal_img_save_path, thermal_img_rect)
-    cv2.imwrite(thermal8_save_path, thermal_img_normalized_rect)
-    cv2.imwrite(eo_save_path, eo_img_rect)
-    cv2.imwrite(sxs_save_path, thermal_eo_sxs)
-    cv2.imwrite(overlay_save_path, thermal_eo_overlay)
+def write_outputs(rectified, save_paths):
+    for product, img in rectified.items():
+        cv2.imwrite(save_paths[product], img)
 
 
-def stereo_rectify_df(data_dir, sync_df, thermal_mono_10x10_calib_yaml, color_thermal_10x10_calib_yaml, output_dir, rotate180=False):
-    sr_thermal_mono = StereoRectifier(thermal_mono_10x10_calib_yaml)
-    sr_color_thermal = StereoRectifier(color_thermal_10x10_calib_yaml)
+def stereo_rectify_helper(sr, thermal_img_path, eo_img_path, pair_type, output_dir, rotate180=False,
+                          clahe_backend=DEFAULT_CLAHE_BACKEND, cutoffs=None, products=PRODUCTS):
+    make_output_dirs(output_dir, products)
 
-    for idx, row in tqdm.tqdm(sync_df.iterrows(), total=len(sync_df)):
+    thermal_img = cv2.imread(thermal_img_path, -1)
+    eo_img = cv2.imread(eo_img_path, 1)
+    rectified = rectify_thermal_eo_pair(sr, thermal_img, eo_img, pair_type, rotate180, clahe_backend, cutoffs,
+                                        products)
+
+    write_outputs(rectified, output_paths(thermal_img_path, pair_type, output_dir))
+
+
+def row_tasks(data_dir, sync_df, output_dir):
+    # One task per sync row, holding every thermal/EO pairing of its thermal frame
+    for idx, row in sync_df.iterrows():
         thermal_img_path = os.path.join(data_dir, row['thermal_filepath'])
 
+        # Temporally smoothed cutoffs if thermal_autoscale_cutoffs was run, per-frame percentiles otherwise
+        cutoffs = (row['thermal_lo'], row['thermal_hi']) if 'thermal_lo' in row else None
+
         # Do a null check on the filepaths
-        if type(row['mono_filepath']) == str:
-            mono_img_path = os.path.join(data_dir, row['mono_filepath'])
-            stereo_rectify_helper(sr_thermal_mono, thermal_img_path, mono_img_path,
-                                  'thermal_mono', output_dir, rotate180)
-        if type(row['color_filepath']) == str:
-            color_img_path = os.path.join(data_dir, row['color_filepath'])
-            stereo_rectify_helper(sr_color_thermal, thermal_img_path, color_img_path,
-                                  'thermal_color', output_dir, rotate180)
+        pairs = []
+        for pair_type, eo_column in zip(PAIR_TYPES, ['mono_filepath', 'color_filepath']):
+            if type(row[eo_column]) == str:
+                pairs.append({
+                    'key': os.path.join(pair_type, os.path.basename(thermal_img_path)),
+                    'pair_type': pair_type,
+                    'eo_img_path': os.path.join(data_dir, row[eo_column]),
+                })
+
+        if pairs:
+            yield {
+                'key': os.path.basename(thermal_img_path),
+                'thermal_img_path': thermal_img_path,
+                'cutoffs': cutoffs,
+                'output_dir': output_dir,
+                'pairs': pairs,
+            }
+
+
+def rectify_row(srs, thermal_img, eo_imgs, pair_types, rotate180=False, clahe_backend=DEFAULT_CLAHE_BACKEND,
+                cutoffs=None, products=PRODUCTS):
+    # The thermal frame is normalized once and shared by all its pairings
+    thermal8_img = None
+    if set(products) & {'thermal8', 'sxs', 'overlay'}:
+        thermal8_img = normalize_thermal_img(thermal_img, clahe_backend, cutoffs)
+
+    return [rectify_thermal_eo_pair(srs[pair_type], thermal_img, eo_img, pair_type, rotate180, clahe_backend,
+                                    cutoffs, products, thermal8_img)
+            for eo_img, pair_type in zip(eo_imgs, pair_types)]
+
+
+def stereo_rectify_df(data_dir, sync_df, thermal_mono_10x10_calib_yaml, color_thermal_10x10_calib_yaml, output_dir, rotate180=False,
+                      clahe_backend=DEFAULT_CLAHE_BACKEND, products=PRODUCTS):
+    # Serial version of the pipeline below, handy for debugging
+    srs = {
+        'thermal_mono': StereoRectifier(thermal_mono_10x10_calib_yaml),
+        'thermal_color': StereoRectifier(color_thermal_10x10_calib_yaml),
+    }
+    make_output_dirs(output_dir, products)
+
+    tasks = list(row_tasks(data_dir, sync_df, output_dir))
+    for task in tqdm.tqdm(tasks):
+        thermal_img, eo_imgs = read_row_task(task)
+        pair_types = [pair['pair_type'] for pair in task['pairs']]
+        rectified = rectify_row(srs, thermal_img, eo_imgs, pair_types, rotate180, clahe_backend, task['cutoffs'],
+                                products)
+        for pair_type, pair_rectified in zip(pair_types, rectified):
+            write_outputs(pair_rectified, output_paths(task['thermal_img_path'], pair_type, output_dir))
+
+
+# ---------------------- Pipeline stages ----------------------
+
+# Per-process state of the compute workers, set up once by init_rectify_worker
+_worker = {}
+
+
+def init_rectify_worker(calib_yamls, rotate180, clahe_backend, products):
+    # One compute process per core already, keep OpenCV from spawning threads on top
+    cv2.setNumThreads(1)
+    _worker['srs'] = {pair_type: StereoRectifier(calib_yaml) for pair_type, calib_yaml in calib_yamls.items()}
+    _worker['rotate180'] = rotate180
+    _worker['clahe_backend'] = clahe_backend
+    _worker['products'] = products
+
+
+def read_image(path, flags):
+    # Decode from the file's bytes so they can be fingerprinted for the manifest without a second read
+    data = np.fromfile(path, dtype=np.uint8)
+    return cv2.imdecode(data, flags), file_fingerprint(path, data)
+
+
+def read_row_task(task):
+    # The thermal frame is read once for all its pairings
+    thermal_img, thermal_fingerprint = read_image(task['thermal_img_path'], -1)
+    task['inputs'] = {task['thermal_img_path']: thermal_fingerprint}
+
+    eo_imgs = []
+    for pair in task['pairs']:
+        eo_img, eo_fingerprint = read_image(pair['eo_img_path'], 1)
+        eo_imgs.append(eo_img)
+
+        # Kept on the task (readers and writers share the main process) for the writer's manifest records
+        pair['inputs'] = {task['thermal_img_path']: thermal_fingerprint, pair['eo_img_path']: eo_fingerprint}
+    return thermal_img, eo_imgs
+
+
+def rectify_row_task(task, data):
+    thermal_img, eo_imgs = data
+    return rectify_row(_worker['srs'], thermal_img, eo_imgs, [pair['pair_type'] for pair in task['pairs']],
+                       _worker['rotate180'], _worker['clahe_backend'], task['cutoffs'], _worker['products'])
+
+
+def write_row_task(task, rectified, outputs):
+    # outputs maps each output_dir to its TrajectoryOutput
+    output = outputs[task['output_dir']]
+    for pair, pair_rectified in zip(task['pairs'], rectified):
+        output.write(task['thermal_img_path'], pair, pair_rectified)
+
+
+def task_params(task, pair, calib_hashes, rotate180, clahe_backend):
+    # Everything besides the input images that changes a pair's outputs
+    cutoffs = task['cutoffs']
+    return {
+        'calibration': calib_hashes[pair['pair_type']],
+        'rotate180': rotate180,
+        'clahe_backend': clahe_backend,
+        'cutoffs': None if cutoffs is None else [float(c) for c in cutoffs],
+    }
+
+
+class TrajectoryOutput:
+    """
+    Destination of one trajectory's rectified pairs, image files or shards under output_dir, and the manifest
+    that lets re-runs skip pairs whose outputs are up to date with their inputs, calibration and parameters.
+    """
+
+    def __init__(self, output_dir, products=PRODUCTS, sink='files', shard_size=DEFAULT_SHARD_BYTES):
+        self.output_dir = output_dir
+        self.products = products
+        if sink == 'shards':
+            self.shards = ShardWriter(os.path.join(output_dir, 'shards'), prefix='rectified',
+                                      max_shard_bytes=shard_size)
+            self.exists = self.shards.has
+        else:
+            make_output_dirs(output_dir, products)
+            self.shards = None
+            self.exists = os.path.isfile
+        self.manifest = Manifest(os.path.join(output_dir, 'manifest.jsonl'))
+
+    def save_paths(self, thermal_img_path, pair_type):
+        if self.shards is None:
+            return output_paths(thermal_img_path, pair_type, self.output_dir)
+        return shard_members(thermal_img_path, pair_type)
+
+    def is_current(self, thermal_img_path, pair):
+        save_paths = self.save_paths(thermal_img_path, pair['pair_type'])
+        return self.manifest.is_current(pair['key'], [thermal_img_path, pair['eo_img_path']], pair['params'],
+                                        [save_paths[product] for product in self.products], self.exists)
+
+    def write(self, thermal_img_path, pair, rectified):
+        save_paths = self.save_paths(thermal_img_path, pair['pair_type'])
+        if self.shards is None:
+            write_outputs(rectified, save_paths)
+        else:
+            for product, img in rectified.items():
+                self.shards.add_image(save_paths[product], img)
+
+        # Only recorded once every output is on disk, so an interrupted pair is redone on the next run
+        self.manifest.record(pair['key'], pair['inputs'], pair['params'], [save_paths[p] for p in rectified])
+
+    def close(self):
+        self.manifest.close()
+        if self.shards is not None:
+            self.shards.close()
+
+
+def trajectory_tasks(data_dir, sync_df, output, calib_hashes, rotate180=False, clahe_backend=DEFAULT_CLAHE_BACKEND,
+                     force=False):
+    """
+    Row tasks of one trajectory, restricted to the pairs that are not up to date in output.
+
+    :return: tasks, number of pairs in the trajectory, number of pairs to process
+    """
+    tasks = []
+    n_pairs = 0
+    n_todo = 0
+    for task in row_tasks(data_dir, sync_df, output.output_dir):
+        pairs = []
+        for pair in task['pairs']:
+            pair['params'] = task_params(task, pair, calib_hashes, rotate180, clahe_backend)
+            if force or not output.is_current(task['thermal_img_path'], pair):
+                pairs.append(pair)
+
+        n_pairs += len(task['pairs'])
+        n_todo += len(pairs)
+        if pairs:
+            task['pairs'] = pairs
+            tasks.append(task)
+    return tasks, n_pairs, n_todo
+
+
+def run_rectify_pipeline(tasks, outputs, calib_yamls, rotate180=False, clahe_backend=DEFAULT_CLAHE_BACKEND,
+                         n_workers=None, products=PRODUCTS, desc='Rectifying frames'):
+    # Tasks may come from any number of trajectories, each written to its entry of outputs
+    pipeline = Pipeline(read_row_task, rectify_row_task, functools.partial(write_row_task, outputs=outputs),
+                        n_workers=n_workers, initializer=init_rectify_worker,
+                        initargs=(calib_yamls, rotate180, clahe_backend, products))
+    return pipeline.run(tasks, total=len(tasks), desc=desc)
+
+
+def stereo_rectify_pipeline(data_dir, sync_df, calib_yamls, output_dir, rotate180=False,
+                            clahe_backend=DEFAULT_CLAHE_BACKEND, n_workers=None, force=False, products=PRODUCTS,
+                            sink='files', shard_size=DEFAULT_SHARD_BYTES):
+    output = TrajectoryOutput(output_dir, products, sink, shard_size)
+    calib_hashes = {pair_type: calibration_file_hash(calib_yaml) for pair_type, calib_yaml in calib_yamls.items()}
+
+    tasks, n_pairs, n_todo = trajectory_tasks(data_dir, sync_df, output, calib_hashes, rotate180, clahe_backend,
+                                              force)
+    print('{} of {} pairs up to date, processing {} ({} thermal frames)'.format(
+        n_pairs - n_todo, n_pairs, n_todo, len(tasks)))
+
+    stats = run_rectify_pipeline(tasks, {output_dir: output}, calib_yamls, rotate180, clahe_backend, n_workers,
+                                 products)
+    output.close()
+    return stats
+
+
+def load_sync_df(data_dir, thermal_csv, mono_csv, color_csv, output_dir, sync_tolerance=SYNC_TOLERANCE,
+                 thermal_smoothing=None, thermal_stats=None):
+    # Synchronized pairs of a trajectory, with smoothed thermal cutoffs if thermal_smoothing is set
+    csv_dir = os.path.join(data_dir, 'csv')
+
+    thermal_sync_csv = os.path.join(csv_dir, thermal_csv)
+    mono_sync_csv = os.path.join(csv_dir, mono_csv)
+    color_sync_csv = os.path.join(csv_dir, color_csv)
+
+    sync_df = synchronize_df(thermal_sync_csv, mono_sync_csv, color_sync_csv, sync_tolerance,
+                             sidecar_dir=os.path.join(data_dir, 'sync'))
+
+    if thermal_smoothing is not None:
+        thermal_stats = thermal_stats or os.path.join(output_dir, 'thermal_autoscale_stats.json')
+        sync_df = thermal_autoscale_cutoffs(data_dir, sync_df, thermal_stats, thermal_smoothing)
+    return sync_df
+
+
+def add_rectify_args(parser):
+    # Processing options shared with batch_stereo_rectify.py
+    parser.add_argument('--rotate180', action='store_true')
+    parser.add_argument('--sync_tolerance', type=float, default=SYNC_TOLERANCE,
+                        help='Max time difference (s) between a thermal frame and its matched EO frames')
+    parser.add_argument('--clahe_backend', type=str, default=DEFAULT_CLAHE_BACKEND, choices=CLAHE_BACKENDS,
+                        help='skimage reproduces previously released thermal8 images, opencv is much faster')
+    parser.add_argument('--thermal_smoothing', type=float, default=None,
+                        help='EMA weight (0-1] of each frame\'s autoscale cutoffs. Default: independent per-frame cutoffs')
+    parser.add_argument('--n_workers', type=int, default=None,
+                        help='Compute processes. Default: one per core (readers and writers are sized to match)')
+    parser.add_argument('--outputs', type=str, default=','.join(PRODUCTS),
+                        help='Comma separated products to write, from {}. sxs and overlay can also be rendered '
+                             'later from thermal8 and eo with render_views.py'.format(','.join(PRODUCTS)))
+    parser.add_argument('--sink', type=str, default='files', choices=SINKS,
+                        help='files: one image per product and pair. shards: packed into output_dir/shards/*.tar '
+                             'with an offset index (read with utils.shards.ShardReader)')
+    parser.add_argument('--shard_size_mb', type=int, default=DEFAULT_SHARD_BYTES >> 20,
+                        help='Start a new shard once the current one reaches this size')
+    parser.add_argument('--force', action='store_true',
+                        help='Reprocess every pair, even those the manifest records as up to date')
+
+    parser.add_argument('--thermal_mono_calib_yaml', type=str,
+                        default='calibrations/thermal_mono_10x10_calib.yaml')
+    parser.add_argument('--color_thermal_calib_yaml', type=str,
+                        default='calibrations/color_thermal_10x10_calib.yaml')
+
+
+def parse_products(parser, args):
+    products = [product for product in args.outputs.split(',') if product]
+    unknown = set(products) - set(PRODUCTS)
+    if unknown or not products:
+        parser.error('--outputs must be a comma separated subset of {}'.format(','.join(PRODUCTS)))
+    return products
 
 
 if __name__ == '__main__':
@@ -137,35 +442,28 @@ if __name__ == '__main__':
     parser.add_argument('--thermal_csv', type=str, required=True)
     parser.add_argument('--mono_csv', type=str, required=True)
     parser.add_argument('--color_csv', type=str, required=True)
-    parser.add_argument('--rotate180', action='store_true')
-
-    parser.add_argument('--thermal_mono_calib_yaml', type=str,
-                        default='calibrations/thermal_mono_10x10_calib.yaml')
-    parser.add_argument('--color_thermal_calib_yaml', type=str,
-                        default='calibrations/color_thermal_10x10_calib.yaml')
+    parser.add_argument('--thermal_stats', type=str, default=None,
+                        help='Per-trajectory thermal statistics file. Default: output_dir/thermal_autoscale_stats.json')
+    add_rectify_args(parser)
 
     parser.add_argument('--output_dir', type=str, required=True)
     args = parser.parse_args()
     print(args)
 
-    csv_dir = os.path.join(args.data_dir, 'csv')
-
-    thermal_sync_csv = os.path.join(csv_dir, args.thermal_csv)
-    mono_sync_csv = os.path.join(csv_dir, args.mono_csv)
-    color_sync_csv = os.path.join(csv_dir, args.color_csv)
+    products = parse_products(parser, args)
 
-    sync_df = synchronize_df(thermal_sync_csv, mono_sync_csv, color_sync_csv)
+    sync_df = load_sync_df(args.data_dir, args.thermal_csv, args.mono_csv, args.color_csv, args.output_dir,
+                           args.sync_tolerance, args.thermal_smoothing, args.thermal_stats)
     # stereo_rectify_df(args.data_dir, sync_df, args.thermal_mono_calib_yaml,
     #                   args.color_thermal_calib_yaml, args.output_dir, rotate180=args.rotate180)
 
-    n_jobs = 8
-    results = Parallel(n_jobs=n_jobs)(delayed(stereo_rectify_df)(
-        args.data_dir,
-        df,
-        args.thermal_mono_calib_yaml,
-        args.color_thermal_calib_yaml,
-        args.output_dir,
-        rotate180=args.rotate180
-    )
-        for df in np.array_split(sync_df, n_jobs)
-    )
+    calib_yamls = {
+        'thermal_mono': args.thermal_mono_calib_yaml,
+        'thermal_color': args.color_thermal_calib_yaml,
+    }
+    stats = stereo_rectify_pipeline(args.data_dir, sync_df, calib_yamls, args.output_dir,
+                                    rotate180=args.rotate180, clahe_backend=args.clahe_backend,
+                                    n_workers=args.n_workers, force=args.force, products=products,
+                                    sink=args.sink, shard_size=args.shard_size_mb << 20)
+    if stats['failures'] > 0:
+        raise SystemExit(1)
@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+import threading
+
+
+def file_fingerprint(path, data=None):
+    """
+    Size, modification time and SHA-1 of a file. Pass data if the file's bytes were already read.
+    """
+    st = os.stat(path)
+    if data is None:
+        with open(path, 'rb') as f:
+            data = f.read()
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'sha1': hashlib.sha1(data).hexdigest()}
+
+
+def _same_content(inputs_a, inputs_b):
+    return {path: fp['sha1'] for path, fp in inputs_a.items()} == {path: fp['sha1'] for path, fp in inputs_b.items()}
+
+
+class Manifest:
+    """
+    Per-trajectory record of how each output was produced, so re-runs only redo what is stale.
+
+    Every completed task appends one JSON line holding its inputs (size, mtime and content hash), the
+    processing parameters (calibration hash included) and its outputs. Records are flushed as they are
+    written, so a crashed run resumes after the last finished task. Later lines supersede earlier ones.
+
+    A task is up to date if its parameters match, the outputs asked for were recorded and still exist, and
+    each input is unchanged. Inputs whose size and mtime match are trusted, otherwise their content hash
+    decides (e.g. after a copy).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        self.lock = threading.Lock()
+        self.dirty = False
+
+        n_lines = 0
+        if os.path.isfile(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Last line of a run killed mid-write
+                        continue
+                    self.records[record['key']] = record
+                    n_lines += 1
+
+        # Drop superseded records so the file does not grow with every re-run
+        if n_lines > len(self.records):
+            self.compact()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.file = open(path, 'a')
+
+    def compact(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for record in self.records.values():
+                f.write(json.dumps(record) + '\n')
+        os.replace(tmp_path, self.path)
+
+    def is_current(self, key, input_paths, params, output_paths=None, exists=os.path.isfile):
+        # exists checks the recorded outputs, e.g. ShardWriter.has when they are packed into shards
+        record = self.records.get(key)
+        if record is None or record['params'] != params:
+            return False
+        if sorted(record['inputs']) != sorted(input_paths):
+            return False
+        if output_paths is not None and not set(output_paths) <= set(record['outputs']):
+            return False
+        if not all(exists(path) for path in record['outputs']):
+            return False
+
+        for path, fingerprint in record['inputs'].items():
+            try:
+                st = os.stat(path)
+            except OSError:
+                return False
+            if st.st_size == fingerprint['size'] and st.st_mtime_ns == fingerprint['mtime_ns']:
+                continue
+
+            current = file_fingerprint(path)
+            if current['sha1'] != fingerprint['sha1']:
+                return False
+
+            # Same content, new mtime: remember it so the next run does not hash the file again
+            with self.lock:
+                record['inputs'][path] = current
+                self.dirty = True
+        return True
+
+    def record(self, key, inputs, params, outputs):
+        """
+        :param inputs: dict of input path -> file_fingerprint
+        :param outputs: list of output paths
+        """
+        outputs = list(outputs)
+        with self.lock:
+            # Outputs written earlier from the same inputs and parameters are still valid, keep them
+            previous = self.records.get(key)
+            if previous is not None and previous['params'] == params and \
+                    _same_content(previous['inputs'], inputs):
+                outputs += [path for path in previous['outputs'] if path not in outputs]
+
+            record = {'key': key, 'inputs': inputs, 'params': params, 'outputs': outputs}
+            self.records[key] = record
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+        if self.dirty:
+            self.compact()
@@ -0,0 +1,193 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import tqdm
+
+
+# Marks the end of a stage's input
+_DONE = object()
+
+
+def _timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+class StageStats:
+
+    def __init__(self, name, n_threads):
+        self.name = name
+        self.n_threads = n_threads
+        self.count = 0
+        self.busy = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.count += 1
+            self.busy += seconds
+
+    def as_dict(self, wall):
+        return {
+            'items': self.count,
+            'items_per_s': self.count / wall if wall > 0 else 0.0,
+            'busy_s': self.busy,
+            'utilization': self.busy / (wall * self.n_threads) if wall > 0 else 0.0,
+            'n_threads': self.n_threads,
+        }
+
+
+class Pipeline:
+    """
+    Streaming read -> compute -> write engine.
+
+    read_fn(item) runs on a thread pool (image decoding and encoding release the GIL), compute_fn(item, data)
+    on a process pool and write_fn(item, result) on a second thread pool. The stages are joined by bounded
+    queues, so memory stays flat however many items are fed in, and a slow disk or an expensive item only
+    holds up its own slot instead of a whole static chunk.
+
+    compute_fn must be picklable (a module level function). Per-process state, e.g. rectifiers, is set up
+    once per worker by initializer(*initargs). Pool sizes default to the core count.
+    """
+
+    def __init__(self, read_fn, compute_fn, write_fn, n_workers=None, n_readers=None, n_writers=None,
+                 queue_size=None, initializer=None, initargs=()):
+        n_cpu = os.cpu_count() or 1
+        self.read_fn = read_fn
+        self.compute_fn = compute_fn
+        self.write_fn = write_fn
+
+        self.n_workers = n_workers or n_cpu
+        # Readers and writers mostly wait on the disk, a few more threads than cores keeps it busy
+        self.n_readers = n_readers or min(2 * n_cpu, 16)
+        self.n_writers = n_writers or min(2 * n_cpu, 16)
+        self.queue_size = queue_size or 2 * self.n_workers
+
+        self.initializer = initializer
+        self.initargs = initargs
+
+        self.failures = []
+
+    def _fail(self, stage, item, error):
+        self.failures.append((stage, item, error))
+        tqdm.tqdm.write('{} failed for {}: {!r}'.format(stage, item, error))
+
+    def run(self, items, total=None, desc=None):
+        """
+        Push every item through the three stages. Items that raise are reported and skipped.
+
+        :return: dict with per-stage throughput and utilization, wall time and number of failures
+        """
+        read_q = queue.Queue(self.queue_size)
+        compute_q = queue.Queue(self.queue_size)
+        future_q = queue.Queue(self.queue_size)  # Also bounds the tasks waiting inside the process pool
+        write_q = queue.Queue(self.queue_size)
+
+        stats = {
+            'read': StageStats('read', self.n_readers),
+            'compute': StageStats('compute', self.n_workers),
+            'write': StageStats('write', self.n_writers),
+        }
+        self.failures = []
+        progress = tqdm.tqdm(total=total, desc=desc)
+
+        readers_left = [self.n_readers]
+        readers_lock = threading.Lock()
+
+        def reader():
+            while True:
+                item = read_q.get()
+                if item is _DONE:
+                    break
+                try:
+                    data, seconds = _timed(self.read_fn, item)
+                except Exception as e:
+                    self._fail('read', item, e)
+                    progress.update()
+                    continue
+                stats['read'].add(seconds)
+                compute_q.put((item, data))
+
+            # The last reader to finish closes the compute stage
+            with readers_lock:
+                readers_left[0] -= 1
+                if readers_left[0] == 0:
+                    compute_q.put(_DONE)
+
+        def dispatcher(pool):
+            while True:
+                entry = compute_q.get()
+                if entry is _DONE:
+                    break
+                item, data = entry
+                future_q.put((item, pool.submit(_timed, self.compute_fn, item, data)))
+            future_q.put(_DONE)
+
+        def collector():
+            while True:
+                entry = future_q.get()
+                if entry is _DONE:
+                    break
+                item, future = entry
+                try:
+                    result, seconds = future.result()
+                except Exception as e:
+                    self._fail('compute', item, e)
+                    progress.update()
+                    continue
+                stats['compute'].add(seconds)
+                write_q.put((item, result))
+
+            for _ in range(self.n_writers):
+                write_q.put(_DONE)
+
+        def writer():
+            while True:
+                entry = write_q.get()
+                if entry is _DONE:
+                    break
+                item, result = entry
+                try:
+                    _, seconds = _timed(self.write_fn, item, result)
+                    stats['write'].add(seconds)
+                except Exception as e:
+                    self._fail('write', item, e)
+                progress.update()
+
+        start = time.perf_counter()
+        with ProcessPoolExecutor(self.n_workers, initializer=self.initializer, initargs=self.initargs) as pool:
+            threads = [threading.Thread(target=reader, daemon=True) for _ in range(self.n_readers)]
+            threads += [threading.Thread(target=dispatcher, args=(pool,), daemon=True),
+                        threading.Thread(target=collector, daemon=True)]
+            threads += [threading.Thread(target=writer, daemon=True) for _ in range(self.n_writers)]
+            for thread in threads:
+                thread.start()
+
+            for item in items:
+                read_q.put(item)
+            for _ in range(self.n_readers):
+                read_q.put(_DONE)
+
+            for thread in threads:
+                thread.join()
+        wall = time.perf_counter() - start
+        progress.close()
+
+        report = {name: stage.as_dict(wall) for name, stage in stats.items()}
+        report['wall_s'] = wall
+        report['failures'] = len(self.failures)
+        print_report(report)
+        return report
+
+
+def print_report(report):
+    print('{:<8} {:>8} {:>10} {:>12}'.format('stage', 'items', 'items/s', 'utilization'))
+    for name in ['read', 'compute', 'write']:
+        stage = report[name]
+        print('{:<8} {:>8d} {:>10.1f} {:>7.0%} of {:d}'.format(
+            name, stage['items'], stage['items_per_s'], stage['utilization'], stage['n_threads']))
+    print('{:.1f} s wall, {} failed'.format(report['wall_s'], report['failures']))
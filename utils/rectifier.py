@@ -1,8 +1,27 @@
+import hashlib
+import os
+
 import numpy as np
 import cv2
 import yaml
 
 
+# Persisted rectification maps live here, one file per calibration hash
+MAP_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'caltech_aerial_rgbt', 'rectify_maps')
+
+# In-memory maps shared by every StereoRectifier of this process, keyed by calibration hash
+_MAPS = {}
+
+
+def calibration_hash(yaml_bytes):
+    return hashlib.sha1(yaml_bytes).hexdigest()
+
+
+def calibration_file_hash(yaml_file):
+    with open(yaml_file, 'rb') as f:
+        return calibration_hash(f.read())
+
+
 class MonoRectifier:
 
     # ROS calibration files
@@ -19,25 +38,54 @@ class MonoRectifier:
         self.newcameramtx, roi = cv2.getOptimalNewCameraMatrix(self.I, self.D, (self.W, self.H), 0, (self.W, self.H))
         self.new_P = np.hstack([self.newcameramtx, np.zeros((3, 1))])
 
-    def rectify(self, raw_img, rotate_180=False):
-        img = cv2.undistort(raw_img, self.I, self.D, None, self.newcameramtx)
-        if rotate_180:
-            img = cv2.rotate(img, cv2.ROTATE_180)
-        return img
+        # Same maps cv2.undistort builds internally, computed once
+        self.maps = cv2.initUndistortRectifyMap(self.I, self.D, None, self.newcameramtx, (self.W, self.H), cv2.CV_16SC2)
+
+    def rectify(self, raw_img, rotate_180=False, out=None):
+        if not rotate_180:
+            return cv2.remap(raw_img, *self.maps, cv2.INTER_LINEAR, dst=out, borderMode=cv2.BORDER_CONSTANT)
+
+        # Remapping through flipped maps is off by 1 LSB on some 16-bit pixels, rotate afterwards to
+        # match cv2.undistort + cv2.rotate exactly
+        undistorted = cv2.remap(raw_img, *self.maps, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+        return cv2.rotate(undistorted, cv2.ROTATE_180, dst=out)
+
+    def rectify_batch(self, frames, rotate_180=False, out=None):
+        # frames: (N, H, W[, C]) stack or any iterable of frames
+        # out: optional preallocated stack or sequence of output buffers, written in place
+        if isinstance(frames, np.ndarray):
+            if out is None:
+                out = np.empty_like(frames)
+            for i, frame in enumerate(frames):
+                self.rectify(frame, rotate_180, out[i])
+            return out
+
+        rectified = []
+        for i, frame in enumerate(frames):
+            rectified.append(self.rectify(frame, rotate_180, None if out is None else out[i]))
+        return rectified
 
 
 class StereoRectifier:
 
     # Kalibr calibration files
-    def __init__(self, yaml_file):
-        with open(yaml_file, 'r') as f:
-            data = yaml.safe_load(f)
-            self.W0, self.H0 = data["cam0"]["resolution"]
-            self.W1, self.H1 = data["cam1"]["resolution"]
+    # Rectification maps are built once per calibration in the compact CV_16SC2 form and persisted
+    # to map_cache_dir (None to keep them in memory only)
+    def __init__(self, yaml_file, map_cache_dir=MAP_CACHE_DIR):
+        with open(yaml_file, 'rb') as f:
+            yaml_bytes = f.read()
+        self.calib_hash = calibration_hash(yaml_bytes)
+
+        data = yaml.safe_load(yaml_bytes)
+        self.W0, self.H0 = data["cam0"]["resolution"]
+        self.W1, self.H1 = data["cam1"]["resolution"]
 
-            cam0_data, cam1_data, self.Q, self.roi_0, self.roi_1 = self.convert(data)
-            self.K0, self.D0, self.R0, self.P0 = cam0_data
-            self.K1, self.D1, self.R1, self.P1 = cam1_data
+        cam0_data, cam1_data, self.Q, self.roi_0, self.roi_1 = self.convert(data)
+        self.K0, self.D0, self.R0, self.P0 = cam0_data
+        self.K1, self.D1, self.R1, self.P1 = cam1_data
+
+        self.maps0, self.maps1 = self.load_maps(map_cache_dir)
+        self.warps = {}
 
     def load_matrices(self, data):
         intrinsics = data["intrinsics"]
@@ -67,11 +115,72 @@ class StereoRectifier:
             distCoeffs1=D0, distCoeffs2=D1, imageSize=Size, R=R, T=T, flags=cv2.CALIB_ZERO_DISPARITY, alpha=0)
         return (K0, D0, R0, P0), (K1, D1, R1, P1), Q, roi_0, roi_1
 
-    def rectify_img_pair(self, img0, img1):
-
-        xmap0, ymap0 = cv2.initUndistortRectifyMap(self.K0, self.D0, self.R0, self.P0, (self.W0, self.H0), cv2.CV_32FC1)
-        xmap1, ymap1 = cv2.initUndistortRectifyMap(self.K1, self.D1, self.R1, self.P1, (self.W1, self.H1), cv2.CV_32FC1)
-        img0 = cv2.remap(img0, xmap0, ymap0, cv2.INTER_LINEAR, cv2.BORDER_CONSTANT)
-        img1 = cv2.remap(img1, xmap1, ymap1, cv2.INTER_LINEAR, cv2.BORDER_CONSTANT)
+    def build_maps(self):
+        maps0 = cv2.initUndistortRectifyMap(self.K0, self.D0, self.R0, self.P0, (self.W0, self.H0), cv2.CV_16SC2)
+        maps1 = cv2.initUndistortRectifyMap(self.K1, self.D1, self.R1, self.P1, (self.W1, self.H1), cv2.CV_16SC2)
+        return maps0, maps1
+
+    def load_maps(self, map_cache_dir):
+        if self.calib_hash in _MAPS:
+            return _MAPS[self.calib_hash]
+
+        cache_path = None
+        if map_cache_dir is not None:
+            cache_path = os.path.join(map_cache_dir, self.calib_hash + '.npz')
+
+        maps = None
+        if cache_path is not None and os.path.isfile(cache_path):
+            try:
+                with np.load(cache_path) as f:
+                    maps = (f['map0_xy'], f['map0_frac']), (f['map1_xy'], f['map1_frac'])
+            except (OSError, ValueError, KeyError):
+                # Truncated or stale cache file, rebuild it below
+                maps = None
+
+        if maps is None:
+            maps = self.build_maps()
+            if cache_path is not None:
+                self.save_maps(cache_path, maps)
+
+        _MAPS[self.calib_hash] = maps
+        return maps
+
+    def save_maps(self, cache_path, maps):
+        (map0_xy, map0_frac), (map1_xy, map1_frac) = maps
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+
+        # Write to a private file first so concurrent workers never read a partial cache
+        tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, map0_xy=map0_xy, map0_frac=map0_frac, map1_xy=map1_xy, map1_frac=map1_frac)
+        os.replace(tmp_path, cache_path)
+
+    def warp_maps(self, cam, src_offset=(0, 0), rotate_180=False):
+        # Composite warp for cam 0 or 1: the source image sits at src_offset (x, y) inside the
+        # calibrated frame, as if zero padded to it, and the rectified output is optionally rotated
+        # by 180 degrees. Both are baked into the remap tables so no padded or rotated copies are made
+        key = (cam, tuple(src_offset), rotate_180)
+        if key not in self.warps:
+            xy, frac = self.maps0 if cam == 0 else self.maps1
+
+            if tuple(src_offset) != (0, 0):
+                # Shift the integer part of the fixed point map, saturating like cv2.convertMaps does
+                xy = xy.astype(np.int32) - np.array(src_offset, dtype=np.int32)
+                xy = np.clip(xy, np.iinfo(np.int16).min, np.iinfo(np.int16).max).astype(np.int16)
+
+            if rotate_180:
+                xy, frac = xy[::-1, ::-1], frac[::-1, ::-1]
+
+            self.warps[key] = (np.ascontiguousarray(xy), np.ascontiguousarray(frac))
+        return self.warps[key]
+
+    def rectify_imgs(self, cam, *imgs, src_offset=(0, 0), rotate_180=False):
+        # Rectify any number of images taken by one camera (e.g. raw and normalized thermal)
+        maps = self.warp_maps(cam, src_offset, rotate_180)
+        return [cv2.remap(img, *maps, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT) for img in imgs]
+
+    def rectify_img_pair(self, img0, img1, src_offset0=(0, 0), src_offset1=(0, 0), rotate_180=False):
+        img0, = self.rectify_imgs(0, img0, src_offset=src_offset0, rotate_180=rotate_180)
+        img1, = self.rectify_imgs(1, img1, src_offset=src_offset1, rotate_180=rotate_180)
 
         return img0, img1
@@ -0,0 +1,145 @@
+import glob
+import io
+import json
+import os
+import tarfile
+import threading
+import time
+
+import cv2
+import numpy as np
+
+
+INDEX_NAME = 'index.jsonl'
+DEFAULT_SHARD_BYTES = 1 << 30
+
+
+def _load_index(shard_dir):
+    # name -> {name, shard, offset, size}, later lines supersede earlier ones
+    index = {}
+    index_path = os.path.join(shard_dir, INDEX_NAME)
+    if os.path.isfile(index_path):
+        with open(index_path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Last line of a run killed mid-write
+                    continue
+                index[entry['name']] = entry
+    return index
+
+
+def is_shard_dir(path):
+    return os.path.isfile(os.path.join(path, INDEX_NAME))
+
+
+class ShardWriter:
+    """
+    Packs many small encoded images into a few large tar shards plus an offset index, instead of one file each.
+
+    Members keep their relative names (e.g. thermal_mono/000123.thermal8.png), so a shard unpacks with plain
+    tar. Once a member's bytes are flushed, {name, shard, offset, size} is appended to index.jsonl beside the
+    shards, so the index only ever points at complete data and ShardReader can seek straight to any member.
+    A new shard is started when the current one reaches max_shard_bytes. Re-opening a directory continues
+    in a fresh shard; members added again supersede their earlier copies in the index.
+
+    add() may be called from several threads.
+    """
+
+    def __init__(self, shard_dir, prefix='shard', max_shard_bytes=DEFAULT_SHARD_BYTES):
+        os.makedirs(shard_dir, exist_ok=True)
+        self.shard_dir = shard_dir
+        self.prefix = prefix
+        self.max_shard_bytes = max_shard_bytes
+        self.index = _load_index(shard_dir)
+        self.lock = threading.Lock()
+
+        self.n_shards = len(glob.glob(os.path.join(shard_dir, prefix + '-*.tar')))
+        self.tar = None
+        self.shard_name = None
+        self.index_file = open(os.path.join(shard_dir, INDEX_NAME), 'a')
+
+    def _next_shard(self):
+        if self.tar is not None:
+            self.tar.close()
+        self.shard_name = '{}-{:06d}.tar'.format(self.prefix, self.n_shards)
+        self.n_shards += 1
+        self.tar = tarfile.open(os.path.join(self.shard_dir, self.shard_name), 'w', format=tarfile.PAX_FORMAT)
+
+    def add(self, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = time.time()
+
+        with self.lock:
+            if self.tar is None or self.tar.offset >= self.max_shard_bytes:
+                self._next_shard()
+            self.tar.addfile(info, io.BytesIO(data))
+            self.tar.fileobj.flush()
+
+            # The data is followed by padding up to the next 512 byte block, its start is found from the end
+            offset = self.tar.offset - (len(data) + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+            entry = {'name': name, 'shard': self.shard_name, 'offset': offset, 'size': len(data)}
+            self.index_file.write(json.dumps(entry) + '\n')
+            self.index_file.flush()
+            self.index[name] = entry
+
+    def add_image(self, name, img, params=()):
+        # The member's extension picks the encoding, as with cv2.imwrite
+        ok, buf = cv2.imencode(os.path.splitext(name)[1], img, list(params))
+        if not ok:
+            raise ValueError('Could not encode {}'.format(name))
+        self.add(name, buf.tobytes())
+
+    def has(self, name):
+        entry = self.index.get(name)
+        return entry is not None and os.path.isfile(os.path.join(self.shard_dir, entry['shard']))
+
+    def close(self):
+        with self.lock:
+            if self.tar is not None:
+                self.tar.close()
+                self.tar = None
+            self.index_file.close()
+
+
+class ShardReader:
+    """
+    Random access to the members of a ShardWriter directory by name. Reads are positional, so one reader
+    can be shared between threads.
+    """
+
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        self.index = _load_index(shard_dir)
+        self.fds = {}
+        self.lock = threading.Lock()
+
+    def names(self, prefix=''):
+        return sorted(name for name in self.index if name.startswith(prefix))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def _fd(self, shard):
+        with self.lock:
+            if shard not in self.fds:
+                self.fds[shard] = os.open(os.path.join(self.shard_dir, shard), os.O_RDONLY)
+            return self.fds[shard]
+
+    def read(self, name):
+        entry = self.index[name]
+        return os.pread(self._fd(entry['shard']), entry['size'], entry['offset'])
+
+    def read_image(self, name, flags=cv2.IMREAD_UNCHANGED):
+        return cv2.imdecode(np.frombuffer(self.read(name), np.uint8), flags)
+
+    def close(self):
+        with self.lock:
+            for fd in self.fds.values():
+                os.close(fd)
+            self.fds = {}
@@ -0,0 +1,175 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+DIRECTIONS = ('nearest', 'backward', 'forward')
+TIME_SOURCES = ('Time', 'header')
+
+# Bump when the sidecar contents change so old files are rebuilt
+_SIDECAR_VERSION = 2
+
+
+def read_stream(csv_file, time_source='Time'):
+    """
+    Timestamps and image filenames of one extracted image topic.
+
+    :param time_source: 'Time' for the bag record time, 'header' for the message header stamp
+    """
+    if time_source == 'header':
+        df = pd.read_csv(csv_file, usecols=['header.stamp.secs', 'header.stamp.nsecs', 'filename'])
+        times = df['header.stamp.secs'].to_numpy(np.float64) + df['header.stamp.nsecs'].to_numpy(np.float64) / 1e9
+    else:
+        df = pd.read_csv(csv_file, usecols=[time_source, 'filename'])
+        times = df[time_source].to_numpy(np.float64)
+    return times, df['filename'].to_numpy(dtype=str)
+
+
+def match_times(ref_times, times, tolerance=None, direction='nearest'):
+    """
+    Row of times matched to each of ref_times, -1 where there is none within tolerance.
+
+    times must be sorted. Same rules as pd.merge_asof: 'backward' takes the last row at or before the
+    reference time, 'forward' the first at or after it, 'nearest' the closer of the two (backward on ties).
+    """
+    if direction not in DIRECTIONS:
+        raise ValueError('direction must be one of {}'.format(DIRECTIONS))
+
+    n = len(times)
+    if n == 0:
+        return np.full(len(ref_times), -1, dtype=np.int64)
+
+    backward = np.searchsorted(times, ref_times, side='right') - 1
+    forward = np.searchsorted(times, ref_times, side='left')
+
+    if direction == 'backward':
+        index = backward
+    elif direction == 'forward':
+        index = np.where(forward < n, forward, -1)
+    else:
+        backward_distance = np.where(backward >= 0, ref_times - times[np.maximum(backward, 0)], np.inf)
+        forward_distance = np.where(forward < n, times[np.minimum(forward, n - 1)] - ref_times, np.inf)
+        index = np.where(forward_distance < backward_distance, forward, backward)
+        index[np.isinf(np.minimum(backward_distance, forward_distance))] = -1
+
+    if tolerance is not None:
+        distance = np.abs(times[np.maximum(index, 0)] - ref_times)
+        index = np.where(distance <= tolerance, index, -1)
+
+    return index.astype(np.int64)
+
+
+class SyncIndex:
+    """
+    Frames of several image streams matched to the frames of a reference stream.
+
+    index[i, k] is the row of stream k matched to reference frame i (-1 if none), times are the reference
+    timestamps and stream_times / filenames hold every stream's parsed CSV.
+    """
+
+    def __init__(self, streams, reference, times, index, stream_times, filenames):
+        self.streams = streams
+        self.reference = reference
+        self.times = times
+        self.index = index
+        self.stream_times = stream_times
+        self.filenames = filenames
+
+    @classmethod
+    def build(cls, csv_files, reference=0, tolerance=None, direction='nearest', time_source='Time'):
+        stream_times, filenames = zip(*[read_stream(csv_file, time_source) for csv_file in csv_files])
+        times = stream_times[reference]
+
+        # One vectorized search per other stream. The reference keeps its own rows, searching it would map
+        # duplicate timestamps all to the same row
+        index = np.stack([np.arange(len(times), dtype=np.int64) if k == reference
+                          else match_times(times, t, tolerance, direction)
+                          for k, t in enumerate(stream_times)], axis=1)
+        streams = [os.path.basename(csv_file) for csv_file in csv_files]
+        return cls(streams, reference, times, index, list(stream_times), list(filenames))
+
+    def matched_filenames(self, k):
+        # Filename of stream k for every reference frame, None where unmatched
+        matched = self.filenames[k][np.maximum(self.index[:, k], 0)].astype(object)
+        matched[self.index[:, k] < 0] = None
+        return matched
+
+    def save(self, path, meta):
+        # Best effort, the sidecar is only a cache: False (with a warning) if it can't be written, e.g. on a
+        # read-only dataset
+        arrays = {'times': self.times, 'index': self.index, 'meta': np.array(json.dumps(meta))}
+        for k in range(len(self.streams)):
+            arrays['stream_times_{}'.format(k)] = self.stream_times[k]
+            arrays['filenames_{}'.format(k)] = self.filenames[k]
+
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print('Warning: could not write sync sidecar {}: {}'.format(path, e))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+        return True
+
+    @classmethod
+    def load(cls, path, meta):
+        # None if the sidecar is missing, unreadable or was built from other CSVs or options
+        if not os.path.isfile(path):
+            return None
+        try:
+            with np.load(path) as f:
+                if json.loads(str(f['meta'])) != meta:
+                    return None
+                n = len(meta['streams'])
+                stream_times = [f['stream_times_{}'.format(k)] for k in range(n)]
+                filenames = [f['filenames_{}'.format(k)] for k in range(n)]
+                return cls([s['name'] for s in meta['streams']], meta['reference'], f['times'], f['index'],
+                           stream_times, filenames)
+        except (OSError, ValueError, KeyError):
+            return None
+
+
+def _sidecar_meta(csv_files, reference, tolerance, direction, time_source):
+    streams = []
+    for csv_file in csv_files:
+        st = os.stat(csv_file)
+        streams.append({'name': os.path.basename(csv_file), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns})
+    return {
+        'version': _SIDECAR_VERSION,
+        'streams': streams,
+        'reference': reference,
+        'tolerance': tolerance,
+        'direction': direction,
+        'time_source': time_source,
+    }
+
+
+def synchronize(csv_files, reference=0, tolerance=None, direction='nearest', time_source='Time', sidecar_dir=None):
+    """
+    Match the frames of any number of image CSVs to those of csv_files[reference].
+
+    With sidecar_dir (e.g. the trajectory folder's sync/, beside csv/) the result is cached there as .npz and
+    reused while the CSVs and options are unchanged. If the cache can't be written the index is still returned.
+    """
+    sidecar_path = None
+    if sidecar_dir is not None:
+        meta = _sidecar_meta(csv_files, reference, tolerance, direction, time_source)
+        key = json.dumps([meta['streams'][reference]['name'], [s['name'] for s in meta['streams']],
+                          tolerance, direction, time_source])
+        sidecar_path = os.path.join(sidecar_dir, 'sync-{}.npz'.format(hashlib.sha1(key.encode()).hexdigest()[:16]))
+
+        sync = SyncIndex.load(sidecar_path, meta)
+        if sync is not None:
+            return sync
+
+    sync = SyncIndex.build(csv_files, reference, tolerance, direction, time_source)
+    if sidecar_path is not None:
+        sync.save(sidecar_path, meta)
+    return sync